@@ -0,0 +1,211 @@
+'''
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+
+Tracks the timestamp of the last retrieved CloudWatch data for each domain
+and collection. The timestamps live in the DynamoDB timestamp table, keyed by
+(domain, region). The store reads all of them with BatchGetItem at the start
+of a run, keeps them in memory while the run advances them, and writes the
+ones that moved at the end, in parallel, with conditional updates that never
+move a stored timestamp backwards.
+
+The timestamp is a settled watermark: everything before it has been read
+and CloudWatch won't publish more points for it. Each run re-reads the
+unsettled tail after the watermark, so the store also remembers which points
+of that tail were already sent (the seen set) and filters them out of the
+next read. The seen set lives in memory, or with persist_seen, in the
+timestamp items too, so it survives cold starts.
+
+A run that could not deliver its points calls discard() instead of flush(),
+which drops the run's advances and seen points, so the next run reads the
+same window again.
+'''
+
+import calendar
+import json
+import threading
+
+from dateutil import parser
+
+from client_pool import batch_items
+
+
+class CheckpointStore():
+    ''' In-memory view of the timestamp table. '''
+
+    def __init__(self, client_func, table, persist_seen=False):
+        ''' client_func:  called with no arguments to get a DynamoDB client
+            table:        The table name
+            persist_seen: Store the seen set with the timestamps '''
+        self._client_func = client_func
+        self._table = table
+        self._persist_seen = persist_seen
+        self._timestamps = dict()
+        self._committed = dict()
+        self._seen = dict()
+        self._added = dict()
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(key):
+        (name, region) = key
+        return {'domain': {'S': name}, 'region': {'S': region}}
+
+    def load(self, keys):
+        ''' Read the timestamps for keys, a list of (name, region) tuples.
+            Where memory already holds a newer timestamp (e.g. from an earlier
+            warm invocation whose write failed) the newer one is kept.'''
+        keys = list(dict.fromkeys(keys))
+        ddb = self._client_func()
+        for start in range(0, len(keys), 100):
+            request = {self._table: {'Keys': [self._key(key)
+                                              for key in keys[start:start + 100]]}}
+            try:
+                for resp in batch_items(ddb.batch_get_item, request,
+                                        'UnprocessedKeys'):
+                    for item in resp.get('Responses', {}).get(self._table, []):
+                        iso_ts = item.get('Timestamp', None)
+                        if not iso_ts:
+                            continue
+                        key = (item['domain']['S'], item['region']['S'])
+                        self._merge(key, parser.parse(iso_ts['S']), dirty=False)
+                        if self._persist_seen and 'Seen' in item:
+                            self._merge_seen(key, json.loads(item['Seen']['S']))
+            except Exception as e:
+                print('Exception retrieving timestamps')
+                print(e)
+
+    def _merge(self, key, ts, dirty):
+        with self._lock:
+            existing = self._timestamps.get(key, None)
+            if not existing or existing < ts:
+                self._timestamps[key] = ts
+                if dirty:
+                    self._dirty.add(key)
+            if not dirty:
+                committed = self._committed.get(key, None)
+                if not committed or committed < ts:
+                    self._committed[key] = ts
+
+    def _merge_seen(self, key, stored):
+        with self._lock:
+            seen = self._seen.setdefault(key, dict())
+            for series, epochs in stored.items():
+                seen.setdefault(series, set()).update(epochs)
+
+    def get(self, name, region):
+        ''' The last timestamp for name in region, or None.'''
+        return self._timestamps.get((name, region), None)
+
+    def advance(self, name, region, ts):
+        ''' Move the timestamp for name in region forward to ts. Does nothing if
+            the stored timestamp is already newer. Safe to call from several
+            threads.'''
+        self._merge((name, region), ts, dirty=True)
+
+    def _prune(self, key):
+        ''' Forget the seen points before key's timestamp, since they won't be
+            read again. Call with the lock held.'''
+        watermark = calendar.timegm(self._timestamps[key].utctimetuple())
+        seen = self._seen.get(key, dict())
+        for series in list(seen):
+            seen[series] = set(epoch for epoch in seen[series]
+                               if epoch >= watermark)
+            if not seen[series]:
+                del seen[series]
+
+    def unseen(self, name, region, series, epochs, settled):
+        ''' Return the positions of the points in epochs (seconds since the
+            epoch) that haven't been seen for series, a string naming one of
+            name's metrics and stats. The new points at or after settled,
+            which the next run reads again, are added to the seen set.'''
+        with self._lock:
+            seen = self._seen.setdefault((name, region), dict()).setdefault(
+                series, set())
+            positions = [pos for pos, epoch in enumerate(epochs)
+                         if epoch not in seen]
+            added = [epochs[pos] for pos in positions if epochs[pos] >= settled]
+            if added:
+                seen.update(added)
+                self._added.setdefault((name, region), dict()).setdefault(
+                    series, set()).update(added)
+            return positions
+
+    def discard(self):
+        ''' Drop the advances and seen points since the last flush, e.g.
+            because the points could not be indexed. The timestamps go back
+            to their stored values, so the next run reads the same window
+            again.'''
+        with self._lock:
+            for key in self._dirty:
+                committed = self._committed.get(key, None)
+                if committed:
+                    self._timestamps[key] = committed
+                else:
+                    self._timestamps.pop(key, None)
+            for key, added in self._added.items():
+                seen = self._seen.get(key, dict())
+                for series, epochs in added.items():
+                    seen[series] = seen.get(series, set()) - epochs
+                    if not seen[series]:
+                        del seen[series]
+            print('Discarded {} timestamps'.format(len(self._dirty)))
+            self._dirty = set()
+            self._added = dict()
+
+    def _update(self, ddb, key, values):
+        ''' Write one timestamp. Returns True if it was written.'''
+        expression = 'SET #ts = :ts'
+        names = {'#ts': 'Timestamp'}
+        if ':seen' in values:
+            expression += ', #seen = :seen'
+            names['#seen'] = 'Seen'
+        try:
+            # The timestamps are all UTC ISO 8601 strings, so they compare
+            # in time order.
+            ddb.update_item(
+                TableName=self._table,
+                Key=self._key(key),
+                UpdateExpression=expression,
+                ConditionExpression='attribute_not_exists(#ts) OR #ts < :ts',
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=values)
+            return True
+        except Exception as e:
+            error = getattr(e, 'response', dict()).get('Error', dict())
+            if error.get('Code', None) != 'ConditionalCheckFailedException':
+                print('Exception updating timestamp for "{}:{}"'.format(*key))
+                print(e)
+        return False
+
+    def flush(self, fan_out=None):
+        ''' Write every timestamp that advanced since the last flush. Runs can
+            overlap, so each write is conditional on the stored timestamp
+            being older. A newer one, written by another run, is left alone,
+            along with its seen set.
+            fan_out: Runs the writes in parallel. Called with a list of
+                     (region, func, args) tuples, like the handler's fan_out.
+                     None writes them one at a time'''
+        with self._lock:
+            updates = list()
+            for key in self._dirty:
+                self._prune(key)
+                self._committed[key] = self._timestamps[key]
+                values = {':ts': {'S': self._timestamps[key].isoformat()}}
+                if self._persist_seen:
+                    seen = self._seen.get(key, dict())
+                    values[':seen'] = {'S': json.dumps(
+                        {series: sorted(epochs) for series, epochs in seen.items()})}
+                updates.append((key, values))
+            self._dirty = set()
+            self._added = dict()
+
+        ddb = self._client_func()
+        calls = [('dynamodb', self._update, (ddb, key, values))
+                 for key, values in updates]
+        if fan_out:
+            written = sum(fan_out(calls))
+        else:
+            written = sum(func(*args) for region, func, args in calls)
+        print('Wrote {} of {} timestamps'.format(written, len(updates)))
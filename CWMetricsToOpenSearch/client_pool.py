@@ -0,0 +1,82 @@
+'''
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+
+Registry of boto3 clients, keyed by (service, region). Building a client
+takes milliseconds of CPU and each one carries its own connection pool, so
+the handler builds each client once and keeps it for the life of the Lambda
+execution environment.
+
+boto3 clients are thread-safe once built, but sessions are not. The pool
+owns a single session and only builds clients while holding its lock.
+
+Also here: batch_items, which drives DynamoDB's batch calls through their
+unprocessed items.
+'''
+
+import random
+import threading
+import time
+
+import boto3
+from botocore.config import Config
+
+
+class ClientPool():
+    ''' Thread-safe cache of boto3 clients. '''
+
+    def __init__(self, max_pool_connections=10):
+        ''' max_pool_connections: size of each client's HTTP connection pool.
+                                  Set this to at least the number of threads
+                                  that share a client.'''
+        self._session = boto3.session.Session()
+        self._config = Config(max_pool_connections=max_pool_connections)
+        self._clients = dict()
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    def client(self, service, region=None):
+        ''' Return the client for service in region, building it on first
+            use. region=None uses the Lambda's own region.'''
+        key = (service, region)
+        with self._lock:
+            client = self._clients.get(key, None)
+            if client:
+                self.reused += 1
+                return client
+            client = self._session.client(service, region_name=region,
+                                          config=self._config)
+            self._clients[key] = client
+            self.created += 1
+            return client
+
+    def report(self):
+        ''' Print and reset the created/reused counters.'''
+        with self._lock:
+            print('boto3 clients: {} created, {} reused, {} pooled'.format(
+                self.created, self.reused, len(self._clients)))
+            self.created = 0
+            self.reused = 0
+
+
+def batch_items(call, request, unprocessed, max_retries=8, backoff_s=0.05,
+                max_backoff_s=5):
+    ''' Call call(RequestItems=request), e.g. a DynamoDB client's
+        batch_get_item, and resend whatever comes back under unprocessed
+        (UnprocessedKeys or UnprocessedItems) until nothing is left. Retries
+        back off exponentially, with full jitter, since unprocessed items
+        mostly mean the table is throttling. Yields each response. Raises
+        RuntimeError if items are still unprocessed after max_retries.'''
+    attempt = 0
+    while request:
+        if attempt > max_retries:
+            raise RuntimeError('DynamoDB left items unprocessed after {} '
+                               'retries'.format(max_retries))
+        if attempt:
+            time.sleep(random.uniform(0, min(max_backoff_s,
+                                             backoff_s * 2 ** attempt)))
+        resp = call(RequestItems=request)
+        yield resp
+        request = resp.get(unprocessed, None)
+        attempt += 1
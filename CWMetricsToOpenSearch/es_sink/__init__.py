@@ -1,7 +1,12 @@
-__all__ = ['descriptor',
+__all__ = ['adaptive_sizing',
+           'bulk_response',
+           'descriptor',
+           'doc_ids',
            'es_transport',
+           'flush_policy',
            'flushing_buffer',
            'line_buffer',
+           'serializer',
            'sqs_transport',
            'transport_exceptions',
            'transport_result',
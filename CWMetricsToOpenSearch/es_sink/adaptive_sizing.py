@@ -0,0 +1,82 @@
+'''
+Copyright 2020, Amazon Web Services Inc.
+This code is licensed under MIT license (see LICENSE.txt for details)
+
+Python 3
+
+Grows and shrinks a FlushPolicy's batch size from what the _bulk requests
+it produces are seeing. Bigger batches mean fewer requests and more
+throughput, up to the point where the cluster's write thread pool backs up
+and starts rejecting. The sizer aims for batches that take about
+target_latency_s to index:
+
+- A request that was throttled (429/503 or a transport error), or had items
+  rejected with a 429, halves the batch size.
+- A request slower than the target shrinks the batch in proportion.
+- A full batch (flushed on docs or bytes, not age) that came in under the
+  target grows the batch, by at most grow_factor per request.
+
+Both max_docs and max_bytes move by the same factor and stay within their
+bounds.
+'''
+
+import threading
+
+from es_sink.flush_policy import TRIGGER_BYTES, TRIGGER_DOCS
+
+
+class AdaptiveBatchSizer():
+    '''Adjusts flush_policy.max_docs and flush_policy.max_bytes after each
+       _bulk request. Pass it to FlushingESBuffer as sizer.'''
+
+    def __init__(self, flush_policy, target_latency_s=1.0,
+                 min_docs=100, max_docs=10000,
+                 min_bytes=256 * 1024, max_bytes=None,
+                 grow_factor=1.25, shrink_factor=0.5):
+        ''' flush_policy:      The FlushPolicy to adjust. Its current limits
+                               are the starting point
+            target_latency_s:  The request time to aim for, in seconds
+            min_docs/max_docs: Bounds for max_docs
+            min_bytes/max_bytes: Bounds for max_bytes. max_bytes defaults to
+                               the policy's starting max_bytes, which should
+                               already be safely below the domain's
+                               http.max_content_length '''
+        self.flush_policy = flush_policy
+        self.target_latency_s = target_latency_s
+        self.min_docs = min_docs
+        self.max_docs = max_docs
+        self.min_bytes = min_bytes
+        self.max_bytes = max_bytes or flush_policy.max_bytes
+        self.grow_factor = grow_factor
+        self.shrink_factor = shrink_factor
+        self._lock = threading.Lock()
+
+    def observe(self, result):
+        '''Update the policy from a flush result dict. Reads took_s, trigger,
+           throttled and rejected. Safe to call from several threads.'''
+        took_s = result.get('took_s', None)
+        if result.get('throttled', False) or result.get('rejected', 0):
+            factor = self.shrink_factor
+        elif took_s is None:
+            return
+        elif took_s > self.target_latency_s:
+            factor = max(self.shrink_factor, self.target_latency_s / took_s)
+        elif result.get('trigger', None) in (TRIGGER_DOCS, TRIGGER_BYTES):
+            factor = self.grow_factor
+            if took_s > 0:
+                factor = min(factor, self.target_latency_s / took_s)
+        else:
+            return
+        self._scale(factor)
+
+    def _scale(self, factor):
+        with self._lock:
+            policy = self.flush_policy
+            if policy.max_docs:
+                policy.max_docs = int(min(self.max_docs,
+                                          max(self.min_docs, policy.max_docs * factor)))
+            if policy.max_bytes:
+                max_bytes = policy.max_bytes * factor
+                if self.max_bytes:
+                    max_bytes = min(self.max_bytes, max_bytes)
+                policy.max_bytes = int(max(self.min_bytes, max_bytes))
@@ -0,0 +1,89 @@
+'''
+Copyright 2020, Amazon Web Services Inc.
+This code is licensed under MIT license (see LICENSE.txt for details)
+
+Python 3
+
+Helpers to read the response to a _bulk request. A _bulk request can succeed
+as a whole and still fail for some of its items, e.g. with a 429
+es_rejected_execution_exception when the write thread pool queue is full.
+The response lists one entry per item, in request order.
+
+Most responses have "errors": false, and parsing the per-item list of a large
+response is costly, so parse_bulk_failures checks the head of the response
+for the errors flag before parsing anything.
+'''
+
+from collections import namedtuple
+import json
+import re
+
+
+# Statuses that are worth retrying, for the whole request or a single item.
+RETRYABLE_STATUSES = frozenset([429, 502, 503, 504])
+
+# A "create" for an _id that already exists. With deterministic ids, this is
+# a document that was already indexed.
+CONFLICT = 409
+
+# position is the 0-based position of the document in the _bulk body.
+BulkItemFailure = namedtuple('BulkItemFailure', ['position', 'status', 'error'])
+
+# "took" comes before "errors" in the response, so the flag is always near the
+# start.
+_ERRORS_FALSE = re.compile(r'"errors"\s*:\s*false')
+_HEAD_CHARS = 100
+
+
+def is_retryable(status):
+    '''True for HTTP statuses that may succeed if sent again.'''
+    return status in RETRYABLE_STATUSES
+
+
+def parse_bulk_failures(result_text):
+    '''Return a list of BulkItemFailures for the items that failed in a _bulk
+       response. Returns an empty list without parsing the items when the
+       response reports no errors.'''
+    if not result_text or _ERRORS_FALSE.search(result_text[:_HEAD_CHARS]):
+        return []
+    response = json.loads(result_text)
+    if not response.get('errors', False):
+        return []
+    failures = list()
+    for position, item in enumerate(response.get('items', [])):
+        # Each item is keyed by its action: index, create, update or delete.
+        for result in item.values():
+            if 'error' in result:
+                failures.append(BulkItemFailure(position=position,
+                                                status=int(result.get('status', 0)),
+                                                error=result['error']))
+    return failures
+
+
+# Dead letters are printed in chunks of at most this many bytes, so each one
+# fits in a single CloudWatch Logs event (256 KiB) instead of being truncated.
+DEAD_LETTER_CHUNK_BYTES = 200 * 1024
+
+
+def print_dead_letter(lines, reason):
+    '''Default dead-letter sink. Writes documents that could not be indexed
+       to the log, split on line boundaries into chunks that CloudWatch Logs
+       keeps whole. lines holds the control and document lines, reason
+       describes the failure.'''
+    lines = bytes(lines)
+    chunks = list()
+    start = 0
+    while start < len(lines):
+        end = start + DEAD_LETTER_CHUNK_BYTES
+        if end < len(lines):
+            newline = lines.rfind(b'\n', start, end)
+            if newline >= start:
+                end = newline + 1
+        chunks.append(lines[start:end])
+        start = end
+    print('Dead-lettering {} bytes of _bulk lines in {} chunks: {}'.format(
+        len(lines), len(chunks), reason))
+    for pos, chunk in enumerate(chunks):
+        print('Dead letter {}/{}\n{}'.format(
+            pos + 1, len(chunks),
+            chunk.decode('utf8', errors='replace').rstrip('\n')))
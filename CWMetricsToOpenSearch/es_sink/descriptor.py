@@ -11,10 +11,14 @@ as well as the log line.
 
 
 from collections import namedtuple
+from datetime import datetime, timedelta
+import json
+import time
 
+from dateutil import parser
 
 from es_sink.es_auth import ESAuth, ESNoAuth, ESSigV4Auth, ESHttpAuth
-from es_sink.transport_utils import now_pst
+from es_sink.transport_utils import now_pst, PACIFIC, UTC
 
 
 class SQSDescriptor():
@@ -58,7 +62,8 @@ class ESDescriptor():
 
            endpoint:            The base url to send REST API calls
            region:              For Amazon ES domains, the AWS region. E.g.
-                                us-west-2
+                                us-west-2. Defaults to the region of an
+                                ESSigV4Auth
            indexing_descriptor: An IndexingDescriptor as above, specifying the
             `                   index name, es type, v7 status, and whether to
                                 create indices with a timestamped name
@@ -80,10 +85,19 @@ class ESDescriptor():
             raise ValueError('You must use the a child of the ESAuth class')
 
 
+        if isinstance(auth, ESSigV4Auth) and not region:
+            region = auth.region
         if isinstance(auth, ESSigV4Auth) and not region:
             raise ValueError('You must specify a region to use SigV4Signing')
         self._region = region
 
+        # (index name, epoch seconds when it expires) for today's index
+        self._today = (None, 0)
+        # UTC hour ('YYYY-MM-DDTHH') -> index name, for index_name_for()
+        self._hour_index = dict()
+        # index name -> (control line, encoded control line + new line)
+        self._control_lines = dict()
+
 
     def user_password(self):
         '''Expose a method to retrieve the username/password.'''
@@ -112,12 +126,58 @@ class ESDescriptor():
         '''Returns true when the index names should carry a timestamp'''
         return self._indexing.timestamped
 
+    def index_name(self):
+        ''' Returns the index name that urls point to today. '''
+        return self._index_name()
+
+    def _daily_name(self, local):
+        return "{}-{}".format(self._indexing.es_index, local.strftime("%Y.%m.%d"))
+
     def _index_name(self):
-        ''' Return es_index-YY.MM.DD. Not timezone-aware '''
-        if self.timestamped():
-            return "{}-{}".format(self._indexing.es_index,
-                                  now_pst().strftime("%Y.%m.%d"))
-        return self._indexing.es_index
+        ''' Return es_index-YY.MM.DD for the current day in US/Pacific. The
+            name is cached until the next Pacific midnight.'''
+        if not self.timestamped():
+            return self._indexing.es_index
+        (name, expires) = self._today
+        if time.time() < expires:
+            return name
+        local = now_pst()
+        midnight = PACIFIC.localize(datetime(local.year, local.month, local.day)
+                                    + timedelta(days=1))
+        name = self._daily_name(local)
+        self._today = (name, midnight.timestamp())
+        return name
+
+    def index_name_for(self, timestamp):
+        ''' Return the index name for a document with the given @timestamp,
+            so late points land in the index for the day they were recorded
+            rather than the day they were sent. timestamp is an ISO 8601
+            string, a datetime (naive means UTC) or seconds since the epoch.
+            Names are cached per UTC hour; Pacific days start on the hour.
+            Falls back to today's index if the timestamp can't be parsed.'''
+        if not self.timestamped():
+            return self._indexing.es_index
+        try:
+            if isinstance(timestamp, str) and timestamp.endswith(('+00:00', 'Z')):
+                key = timestamp[:13]
+            else:
+                if isinstance(timestamp, str):
+                    timestamp = parser.isoparse(timestamp)
+                elif isinstance(timestamp, (int, float)):
+                    timestamp = datetime.fromtimestamp(timestamp, UTC)
+                if timestamp.tzinfo is None:
+                    timestamp = UTC.localize(timestamp)
+                key = timestamp.astimezone(UTC).strftime('%Y-%m-%dT%H')
+            name = self._hour_index.get(key, None)
+            if name is None:
+                hour = UTC.localize(datetime.strptime(key, '%Y-%m-%dT%H'))
+                name = self._daily_name(hour.astimezone(PACIFIC))
+                if len(self._hour_index) >= 1024:
+                    self._hour_index.clear()
+                self._hour_index[key] = name
+            return name
+        except (AttributeError, OverflowError, TypeError, ValueError):
+            return self._index_name()
 
     def base_url(self):
         ''' Returns the endpoint. Slash-terminated.'''
@@ -142,12 +202,13 @@ class ESDescriptor():
             name.'''
         return '{}{}/'.format(self.base_url(), self._index_name())
 
-    def bulk_url(self):
+    def bulk_url(self, index=None):
         ''' d - an ESDescriptor. Returns the base url with _bulk.
             This assumes that you do not want index embedded.
             Set timestamped=True to add the YY.MM.DD to the index
-            name.'''
-        return '{}{}/_bulk'.format(self.base_url(), self._index_name())
+            name. index overrides the index in the url, e.g. to keep posting
+            to the index a buffer was started with.'''
+        return '{}{}/_bulk'.format(self.base_url(), index or self._index_name())
 
     def _es_v7(self):
         return self._indexing.es_v7
@@ -167,13 +228,56 @@ class ESDescriptor():
 
     ACTION_LINE_6 = '{{"index" : {{ "_index" : "{}", "_type": "{}" }} }}'
     ACTION_LINE_7 = '{{"index" : {{ "_index" : "{}" }} }}'
-    def bulk_control_line(self):
+    def _control_line(self, index):
+        index = index or self._index_name()
+        lines = self._control_lines.get(index, None)
+        if lines:
+            return lines
+        if self._es_v7():
+            line = self.ACTION_LINE_7.format(index)
+        else:
+            line = self.ACTION_LINE_6.format(index, self._indexing.es_type)
+        lines = (line, line.encode('utf8') + b'\n')
+        if len(self._control_lines) >= 64:
+            self._control_lines.clear()
+        self._control_lines[index] = lines
+        return lines
+
+    def bulk_control_line(self, index=None):
         ''' Strictly, this shouldn't go in this class. It's not really
             part of a description. OTOH, all the info is here and it will
             save lots of duplicated code.
-            Returns the "control" line for a _bulk request. '''
-        if self._es_v7():
-            return self.ACTION_LINE_7.format(self._index_name())
-
-        return self.ACTION_LINE_6.format(self._index_name(),
-                                         self._indexing.es_type)
+            Returns the "control" line for a _bulk request that indexes into
+            index, by default today's index. Lines are cached per index. '''
+        return self._control_line(index)[0]
+
+    def bulk_control_line_bytes(self, index=None):
+        ''' Returns bulk_control_line(index) UTF-8 encoded and new line
+            terminated, ready to copy into a _bulk body. '''
+        return self._control_line(index)[1]
+
+    # Pre-encoded action lines for requests whose url already names the index
+    INDEX_LINE = b'{"index":{}}\n'
+    CREATE_LINE = b'{"create":{}}\n'
+    def bulk_action_line(self, action='index', index=None, doc_id=None,
+                         url_index=None):
+        ''' Returns the encoded, new line terminated action line for a _bulk
+            request. action is 'index' or 'create'. index defaults to today's
+            index; when it's url_index, the index in the request's url, _index
+            is left out. doc_id sets the document's _id. '''
+        index = index or self._index_name()
+        if doc_id is None:
+            if index == url_index and self._es_v7() and action == 'index':
+                return self.INDEX_LINE
+            if index == url_index and self._es_v7() and action == 'create':
+                return self.CREATE_LINE
+            if index != url_index and action == 'index':
+                return self.bulk_control_line_bytes(index)
+        meta = list()
+        if index != url_index:
+            meta.append('"_index":{}'.format(json.dumps(index)))
+        if not self._es_v7():
+            meta.append('"_type":{}'.format(json.dumps(self._indexing.es_type)))
+        if doc_id is not None:
+            meta.append('"_id":{}'.format(json.dumps(str(doc_id))))
+        return '{{"{}":{{{}}}}}\n'.format(action, ','.join(meta)).encode('utf8')
@@ -0,0 +1,55 @@
+'''
+Copyright 2020, Amazon Web Services Inc.
+This code is licensed under MIT license (see LICENSE.txt for details)
+
+Python 3
+
+Deterministic document _ids. A metric point is identified by its series
+(e.g. region, domain, metric and stat) and its timestamp. Sending the same
+point twice with the same _id and the "create" action makes the second copy a
+cheap 409 version conflict instead of a duplicate document.
+
+Ids are a truncated BLAKE2b digest, base64url encoded. A series sends one
+point per period, so DocIdFactory hashes each series key once, keeps the
+hash state, and only copies it and feeds in the timestamp for each point.
+'''
+
+from base64 import urlsafe_b64encode
+from hashlib import blake2b
+
+
+class DocIdFactory():
+    '''Makes _ids for (series, timestamp) pairs. Safe to share between
+       threads.'''
+
+    def __init__(self, namespace='', digest_size=12, max_series=100000):
+        ''' namespace:   Hashed in front of every series key, e.g. the index
+                         name root, so the same series in two indices gets
+                         different ids
+            digest_size: Bytes of digest to keep. 12 bytes make a 16 character
+                         id
+            max_series:  Number of series whose hash state is kept. The
+                         cache is emptied when it's full'''
+        self._namespace = namespace.encode('utf8')
+        self._digest_size = digest_size
+        self._max_series = max_series
+        self._series = dict()
+
+    def _series_hash(self, series):
+        hasher = self._series.get(series, None)
+        if hasher is None:
+            hasher = blake2b(self._namespace, digest_size=self._digest_size)
+            for part in series:
+                hasher.update(b'\x1f' + str(part).encode('utf8'))
+            if len(self._series) >= self._max_series:
+                self._series.clear()
+            self._series[series] = hasher
+        return hasher
+
+    def doc_id(self, series, timestamp):
+        '''Return the _id for the point at timestamp in series. series is a
+           tuple of the fields that identify the series. timestamp is hashed
+           as str(timestamp), so use the same representation every time.'''
+        hasher = self._series_hash(series).copy()
+        hasher.update(b'\x1e' + str(timestamp).encode('utf8'))
+        return urlsafe_b64encode(hasher.digest()).decode('ascii')
@@ -16,6 +16,11 @@ way is also more self-documenting.
 
 
 from abc import ABC, abstractmethod
+import threading
+import time
+
+import boto3
+from requests_aws4auth import AWS4Auth
 
 
 class ESAuth(ABC):
@@ -40,20 +45,73 @@ class ESNoAuth(ESAuth):
 
 
 class ESSigV4Auth(ESAuth):
-    ''' Use this to have the transport layer grab credentials via Boto. '''
+    ''' Use this to have the transport layer grab credentials via Boto.
+
+        Looking up credentials through the provider chain and building a
+        signer is too slow to do for every request, so the signer is built
+        once and reused until the credentials are within refresh_margin_s of
+        expiring. Credentials without an expiry (e.g. environment variables)
+        are kept for the life of the object. '''
     # Placeholder - eventually should support all of the different auth methods
     # of specifying access/secret and tokens.
-    # Possibly this could do something like: boto3.Session().get_credentials()
 
-    # TODO: Move the aws region into this class. Add a test case for region=None
-    def __init__(self):
+    def __init__(self, region=None, refresh_margin_s=300):
+        ''' region:           The AWS region of the domain. ESDescriptor uses
+                              this when it isn't given a region of its own.
+            refresh_margin_s: Rebuild the signer this many seconds before
+                              the credentials expire.'''
         super(ESSigV4Auth, self).__init__()
+        self._region = region
+        self._refresh_margin_s = refresh_margin_s
+        self._credentials = None
+        self._frozen = None
+        self._signers = dict()
+        self._expires_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def region(self):
+        '''The region of the Amazon ES domain'''
+        return self._region
 
     def auth_creds(self):
         '''Placeholder... this should implement boto-like determination of AWS
            creds.'''
         return None
 
+    def _stale(self):
+        return self._expires_at is not None and time.time() >= self._expires_at
+
+    def signer(self, region, service='es'):
+        ''' Return an AWS4Auth for region and service, reusing the cached one
+            while the credentials are fresh. Safe to call from several
+            threads.'''
+        with self._lock:
+            if self._frozen is None or self._stale():
+                self._refresh()
+            key = (region, service)
+            signer = self._signers.get(key, None)
+            if not signer:
+                signer = AWS4Auth(self._frozen.access_key,
+                                  self._frozen.secret_key, region, service,
+                                  session_token=self._frozen.token)
+                self._signers[key] = signer
+            return signer
+
+    def _refresh(self):
+        ''' Pull current credentials and drop the signers built from the old
+            ones. Called with the lock held.'''
+        if self._credentials is None:
+            self._credentials = boto3.Session().get_credentials()
+        # For refreshable credentials, this fetches new ones if the current
+        # ones are about to expire.
+        self._frozen = self._credentials.get_frozen_credentials()
+        expiry = getattr(self._credentials, '_expiry_time', None)
+        self._expires_at = None
+        if expiry:
+            self._expires_at = expiry.timestamp() - self._refresh_margin_s
+        self._signers = dict()
+
 
 class ESHttpAuth(ESAuth):
     ''' Use with username/password for auth '''
@@ -10,63 +10,90 @@ Elasticsearch.
 
  Use the signed initializer to control whether requests are signed with
 sigV4 auth (via the requests_aws4auth library). When requests are signed
-Transport gets credentials from the environment via Boto.
+Transport gets a signer from the descriptor's ESSigV4Auth, which caches it
+until the credentials it was built from are close to expiring.
+
+ Each ESTransport owns a requests.Session with a keep-alive connection pool,
+so repeated _bulk requests reuse the TCP and TLS connection to the domain
+rather than opening a new one per request.
+
+ Set compress=True to send request bodies gzip-compressed with
+Content-Encoding: gzip. Bulk bodies are repetitive JSON and typically shrink
+by an order of magnitude. TransportResult.size is the uncompressed size and
+wire_size the size actually sent.
 '''
 
-import boto3
+import gzip
+
 import requests
-from requests_aws4auth import AWS4Auth
+from requests.adapters import HTTPAdapter
 
 from es_sink.transport_result import TransportResult
-from es_sink.transport_exceptions import BadHTTPMethod
+from es_sink.transport_exceptions import BadAuth, BadHTTPMethod
 from es_sink.transport_utils import wall_time, valid_request_body
 from es_sink.es_auth import ESAuth
 
 
-def _get_requests_function(method):
-    ''' Pull the right method from requests. '''
+JSON_HEADERS = {"Content-Type": "application/json"}
+GZIP_HEADERS = {"Content-Type": "application/json", "Content-Encoding": "gzip"}
+
+
+def _new_session(pool_size):
+    ''' Build a requests.Session that keeps up to pool_size connections alive
+        per host.'''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def _get_requests_function(session, method):
+    ''' Pull the right method from the session. '''
     try:
-        func = getattr(requests, method)
+        func = getattr(session, method)
         return func
     except AttributeError:
         msg = "{} not a recognized HTTP method".format(method)
         raise BadHTTPMethod(msg)
 
 
-def _send_signed(method, url, service='es', region='us-west-2', body=None):
-    '''Internal method that uses sigV4 signing to send the request.'''
-    credentials = boto3.Session().get_credentials()
-    auth = AWS4Auth(credentials.access_key, credentials.secret_key, region,
-                    service, session_token=credentials.token)
-    func = _get_requests_function(method)
-    (result, took_time) = \
-        wall_time(func, url, auth=auth, data=valid_request_body(body),
-                  headers={"Content-Type":"application/json"})
+def _result(result, took_time, raw_size, wire_body):
     return TransportResult(status=int(result.status_code),
                            result_text=result.text, took_s=took_time,
-                           size=len(body))
+                           size=raw_size, wire_size=len(wire_body))
+
+
+def _send_signed(session, method, url, auth, body=None, headers=None,
+                 raw_size=None):
+    '''Internal method that uses sigV4 signing to send the request. auth is
+       the AWS4Auth signer. The signature covers body as sent, so a
+       compressed body is signed compressed.'''
+    func = _get_requests_function(session, method)
+    (result, took_time) = \
+        wall_time(func, url, auth=auth, data=body,
+                  headers=headers or JSON_HEADERS)
+    return _result(result, took_time,
+                   len(body) if raw_size is None else raw_size, body)
 
 
-def _send_unsigned(method, url, body=None, http_auth=None):
+def _send_unsigned(session, method, url, body=None, http_auth=None,
+                   headers=None, raw_size=None):
     ''' Internal method to pass the request through. '''
-    body = valid_request_body(body)
-    func = _get_requests_function(method)
+    func = _get_requests_function(session, method)
+    raw_size = len(body) if raw_size is None else raw_size
     if http_auth:
         (result, took_time) = \
             wall_time(func, url, data=body,
-                      headers={"Content-Type":"application/json"},
+                      headers=headers or JSON_HEADERS,
                       auth=http_auth,
                       verify=False)
-        return TransportResult(status=int(result.status_code),
-                               result_text=result.text, took_s=took_time,
-                               size=len(body))
+        return _result(result, took_time, raw_size, body)
     (result, took_time) = \
         wall_time(func, url, data=body,
-                  headers={"Content-Type":"application/json"},
+                  headers=headers or JSON_HEADERS,
                   verify=False)
-    return TransportResult(status=int(result.status_code),
-                           result_text=result.text, took_s=took_time,
-                           size=len(body))
+    return _result(result, took_time, raw_size, body)
 
 
 class ESTransport():
@@ -74,7 +101,8 @@ class ESTransport():
         and to provide a facade for Amazon ES domains and local Elasticsearch
         instances.'''
 
-    def __init__(self, descriptor):
+    def __init__(self, descriptor, pool_size=10, compress=False,
+                 compresslevel=3):
         '''A transport object to send requests to Elasticsearch. Since the class
            supports both Amazon ES domains and vanilla ES clusters, this needs
            to provide request signing as well as HTTP auth. The ESDescriptor
@@ -84,9 +112,17 @@ class ESTransport():
 
            descriptor.signed:       Set True to use SigV4 signing only
                                     Set False for HTTP Auth or no auth
-           descriptor.http_auth:    User name, password tuple '''
+           descriptor.http_auth:    User name, password tuple
+           pool_size:               Maximum number of keep-alive connections
+                                    to hold open to the endpoint
+           compress:                Set True to gzip request bodies. The
+                                    cluster must allow http.compression
+           compresslevel:           gzip level, 1 (fastest) to 9 (smallest) '''
 
         self._descriptor = descriptor
+        self._session = _new_session(pool_size)
+        self._compress = compress
+        self._compresslevel = compresslevel
 
         if descriptor.is_signed() and descriptor.is_http_auth():
             raise BadAuth('You can\'t specify both HTTP auth and signed requests')
@@ -107,8 +143,24 @@ class ESTransport():
            descriptor.base_url(). This might be easier, but introduces
            complexity in using the class (how to know how much of the URL to
            specify)'''
+        body = valid_request_body(body)
+        headers = JSON_HEADERS
+        raw_size = None
+        if self._compress and body:
+            if isinstance(body, str):
+                body = body.encode('utf8')
+            raw_size = len(body)
+            body = gzip.compress(body, compresslevel=self._compresslevel)
+            headers = GZIP_HEADERS
         if self.is_signed:
-            return _send_signed(method, url, service, self._descriptor.region,
-                                body=body)
-        return _send_unsigned(method, url, body=body,
-                              http_auth=self._descriptor._auth.auth_creds())
+            signer = self._descriptor.auth().signer(self._descriptor.region,
+                                                    service)
+            return _send_signed(self._session, method, url, signer, body=body,
+                                headers=headers, raw_size=raw_size)
+        return _send_unsigned(self._session, method, url, body=body,
+                              http_auth=self._descriptor._auth.auth_creds(),
+                              headers=headers, raw_size=raw_size)
+
+    def close(self):
+        '''Close the pooled connections.'''
+        self._session.close()
@@ -25,7 +25,7 @@ print(result)
 # Example connecting to Amazon Elasticsearch Service with signed requests
 
 AMAZON_ES_ENDPOINT = "https://your endpoint here"
-amzn_auth = es_auth.ESSigV4Auth()
+amzn_auth = es_auth.ESSigV4Auth(region='us-west-2')
 amzn_index_descriptor = IndexDescriptor(es_index='logs', es_v7=True,
                                         timestamped=True)
 AMAZON_ES_DESCRIPTOR = ESDescriptor(AMAZON_ES_ENDPOINT, amzn_index_descriptor,
@@ -0,0 +1,50 @@
+'''
+Copyright 2020, Amazon Web Services Inc.
+This code is licensed under MIT license (see LICENSE.txt for details)
+
+Python 3
+
+Decides when a FlushingESBuffer should send its contents. A policy combines
+up to three limits, any of which triggers a flush:
+
+max_docs            Number of documents in the buffer
+max_bytes           Size of the _bulk body, control lines included. Keep this
+                    well under the domain's http.max_content_length
+max_age_s           Seconds since the first document went into an empty
+                    buffer. Checked as lines are added, so a slow trickle
+                    still goes out in a timely fashion
+'''
+
+import time
+
+
+TRIGGER_DOCS = 'docs'
+TRIGGER_BYTES = 'bytes'
+TRIGGER_AGE = 'age'
+TRIGGER_MANUAL = 'manual'
+
+
+class FlushPolicy():
+    '''Set of limits for a FlushingESBuffer. A limit of None is not checked.'''
+
+    def __init__(self, max_docs=None, max_bytes=None, max_age_s=None):
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.max_age_s = max_age_s
+
+    def trigger(self, buffer, started):
+        '''Return the name of the first limit the buffer has reached, or None.
+           buffer is an ESLineBuffer, started the time.monotonic() value when
+           its first document was added.'''
+        if self.max_docs and buffer.es_doc_count() >= self.max_docs:
+            return TRIGGER_DOCS
+        if self.max_bytes and buffer.buffer_bytes() >= self.max_bytes:
+            return TRIGGER_BYTES
+        if self.max_age_s is not None and started is not None and \
+           time.monotonic() - started >= self.max_age_s:
+            return TRIGGER_AGE
+        return None
+
+    def __repr__(self):
+        return 'FlushPolicy(max_docs={}, max_bytes={}, max_age_s={})'.format(
+            self.max_docs, self.max_bytes, self.max_age_s)
@@ -10,57 +10,331 @@ as well as the log line.
 
 Employs an line_buffer to hold log lines as they are added. Optionally
 sends monitor information to an ES cluster. Set the flush_trigger to
-control how many lines are buffered before each flush.
+control how many lines are buffered before each flush, or pass a
+FlushPolicy to also limit the buffer by bytes and age. Set max_in_flight
+to send _bulk requests from background threads.
+
+Each _bulk response is checked for failed items. Items that failed with a
+retryable status (429, 502, 503, 504) are sent again, alone, after an
+exponential backoff with full jitter, as is the whole request when it fails
+outright. Whatever still fails after max_retries, or fails with a status
+that won't change on a retry, goes to the dead_letter sink. With the "create"
+action, a 409 conflict means the document is already indexed, so it's
+counted as a duplicate rather than a failure.
+
+Dead-lettered documents that were never rejected on their own merits, i.e.
+the whole request failed or the retries ran out, are also counted as
+undelivered. Sending them again later may work, so the caller should not
+treat them as done.
 '''
 
+from concurrent.futures import ThreadPoolExecutor
+import random
+import threading
 import time
 
+from es_sink.bulk_response import CONFLICT, is_retryable, \
+    parse_bulk_failures, print_dead_letter
 from es_sink.descriptor import ESDescriptor, SQSDescriptor
 from es_sink.line_buffer import ESLineBuffer, SQSLineBuffer
 from es_sink.es_transport import ESTransport
+from es_sink.flush_policy import FlushPolicy, TRIGGER_MANUAL
 from es_sink.sqs_transport import SQSTransport
 from es_sink.transport_exceptions import BadSink
 
+# Counts that flush(wait=True) totals across requests
+TOTAL_KEYS = ('requests', 'docs', 'failed', 'retries', 'dead_lettered',
+              'undelivered', 'duplicates', 'rejected')
+
 class FlushingESBuffer():
     '''Wraps an ESLineBuffer object to provide _bulk flushing when the
-       flush_trigger is hit.'''
+       flush policy triggers.
 
-    def __init__(self, descriptor, flush_trigger=1):
-        ''' target_descriptor must be an ESDescriptor'''
-        self.transport = ESTransport(descriptor)
+       With max_in_flight > 0, flushes triggered by add_log_line run in the
+       background: the full buffer is handed to a sender thread and a fresh
+       one takes its place, so the caller can keep filling while the _bulk
+       request is out. At most max_in_flight requests are out at once. When
+       that limit is hit, add_log_line blocks until a request finishes. Call
+       flush() (or close()) before returning to wait for all of them.'''
+
+    def __init__(self, descriptor, flush_trigger=1, pool_size=10,
+                 flush_policy=None, max_in_flight=0, max_retries=3,
+                 backoff_s=0.5, max_backoff_s=10, dead_letter=print_dead_letter,
+                 sizer=None, compress=False, compresslevel=3,
+                 route_by_timestamp=False, index_in_url=False, action='index'):
+        ''' target_descriptor must be an ESDescriptor. The transport keeps up
+            to pool_size connections to the endpoint alive between flushes.
+            flush_policy is a FlushPolicy. When it's None, the buffer flushes
+            every flush_trigger docs. max_in_flight is the number of _bulk
+            requests that may run in the background; 0 sends them
+            synchronously. pool_size should be at least max_in_flight.
+            Failed items are retried up to max_retries times, waiting a
+            random time up to backoff_s * 2^attempt (capped at max_backoff_s)
+            before each retry. dead_letter(lines, reason) receives the _bulk
+            lines that could not be indexed. sizer, e.g. an
+            AdaptiveBatchSizer, is given each flush result to tune the flush
+            policy. compress and compresslevel turn on gzip request bodies in
+            the transport. route_by_timestamp sends each doc to the daily
+            index for its @timestamp. index_in_url leaves _index out of the
+            action lines for docs that go to the index in the url. action is
+            the _bulk action, 'index' or 'create' (see ESLineBuffer).'''
+        self.transport = ESTransport(descriptor, pool_size=pool_size,
+                                     compress=compress,
+                                     compresslevel=compresslevel)
         self.target_descriptor = descriptor
         self.flush_trigger = flush_trigger
-        self.buffer = ESLineBuffer(descriptor)
+        self.flush_policy = flush_policy or FlushPolicy(max_docs=flush_trigger)
+        self.max_retries = max_retries
+        self.backoff_s = backoff_s
+        self.max_backoff_s = max_backoff_s
+        self.dead_letter = dead_letter
+        self.sizer = sizer
+        self.route_by_timestamp = route_by_timestamp
+        self.index_in_url = index_in_url
+        self.action = action
+        self.raw_bytes_sent = 0
+        self.wire_bytes_sent = 0
+        self._stats_lock = threading.Lock()
+        self._totals = dict.fromkeys(TOTAL_KEYS, 0)
+        self.buffer = self._new_buffer()
+        self._started = None
+        self.max_in_flight = max_in_flight
+        self._executor = None
+        self._slots = None
+        self._pending = list()
+        self._error = None
+        if max_in_flight > 0:
+            self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+            self._slots = threading.BoundedSemaphore(max_in_flight)
 
-    def add_log_line(self, log_line):
-        '''Add a single log line to the internal buffer. If the flush trigger
-           is hit, send the bulk request.'''
-        self.buffer.add_log_line(log_line)
-        if self.buffer.es_doc_count() >= self.flush_trigger:
-            return self.flush() # swallows the result. Do something with it?
+    def _new_buffer(self):
+        return ESLineBuffer(self.target_descriptor,
+                            route_by_timestamp=self.route_by_timestamp,
+                            index_in_url=self.index_in_url,
+                            action=self.action)
+
+    def add_log_line(self, log_line, doc_id=None):
+        '''Add a single log line to the internal buffer, with _id doc_id if
+           given. If the flush policy triggers, send the bulk request.'''
+        if self._started is None:
+            self._started = time.monotonic()
+        self.buffer.add_log_line(log_line, doc_id)
+        return self._check_flush()
+
+    def add_doc_bytes(self, line, timestamp=None, doc_id=None):
+        '''Add a document that is already serialized to UTF-8 JSON, with its
+           @timestamp (see ESLineBuffer.add_doc_bytes) and _id doc_id if
+           given. If the flush policy triggers, send the bulk request.'''
+        if self._started is None:
+            self._started = time.monotonic()
+        self.buffer.add_doc_bytes(line, timestamp, doc_id)
+        return self._check_flush()
+
+    def _check_flush(self):
+        trigger = self.flush_policy.trigger(self.buffer, self._started)
+        if trigger:
+            return self.flush(trigger=trigger, wait=False) # swallows the result. Do something with it?
         return (0, None)
 
-    def flush(self):
-        '''Flushes the line_buffer, sending all to the _bulk API'''
-        before_doc_count = self.buffer.es_doc_count()
-        if self.buffer.es_doc_count() > 0:
+    def _backoff(self, attempt):
+        '''Full jitter exponential backoff.'''
+        time.sleep(random.uniform(0, min(self.max_backoff_s,
+                                         self.backoff_s * 2 ** attempt)))
+
+    def _send(self, buffer, trigger):
+        '''Send buffer to the _bulk API, retrying failures. Returns the result
+           of the first request as a dict, with counts for the whole
+           exchange: docs, failed (items that failed at least once), retries,
+           dead_lettered, undelivered (dead-lettered because the request
+           failed or retries ran out) and duplicates ("create" items that
+           already existed, which aren't failures). throttled and rejected describe the first
+           request: whether it was throttled as a whole, and how many items
+           it had rejected with a 429.'''
+        url = self.target_descriptor.bulk_url(buffer.url_index)
+        print("Flushing {} documents ({} bytes, trigger: {}) {} to {}".format(
+            buffer.es_doc_count(),
+            buffer.buffer_bytes(),
+            trigger,
+            time.time(),
+            url))
+        docs = buffer.es_doc_count()
+        first = None
+        failed = 0
+        rejected = 0
+        throttled = False
+        dead_lettered = 0
+        undelivered = 0
+        duplicates = 0
+        attempt = 0
+        while True:
+            retry = self._new_buffer()
             try:
-                url = self.target_descriptor.bulk_url()
-                print("Flushing {} documents {} to {}".format(
-                    self.buffer.es_doc_count(),
-                    time.time(),
-                    url))
-                result = self.transport.send('post', url, body=str(self.buffer))
-                result = result._asdict()
-                result['docs'] = self.buffer.es_doc_count()
-                self.buffer.clear()
-                return (before_doc_count, result)
+                result = self.transport.send('post', url, body=buffer.body())
+                with self._stats_lock:
+                    self.raw_bytes_sent += result.size
+                    self.wire_bytes_sent += result.wire_size or result.size
+                first = first or result
+                if is_retryable(result.status):
+                    retry, reason = buffer, 'HTTP {}'.format(result.status)
+                    throttled = throttled or attempt == 0
+                elif result.status >= 300:
+                    self.dead_letter(buffer.body(), 'HTTP {}: {}'.format(
+                        result.status, result.result_text))
+                    dead_lettered += buffer.es_doc_count()
+                    undelivered += buffer.es_doc_count()
+                else:
+                    failures = parse_bulk_failures(result.result_text)
+                    if buffer.action == 'create':
+                        conflicts = [failure for failure in failures
+                                     if failure.status == CONFLICT]
+                        duplicates += len(conflicts)
+                        if conflicts:
+                            failures = [failure for failure in failures
+                                        if failure.status != CONFLICT]
+                    if attempt == 0:
+                        failed = len(failures)
+                        rejected = sum(1 for failure in failures
+                                       if failure.status == 429)
+                    for failure in failures:
+                        lines = buffer.bulk_lines(failure.position)
+                        if is_retryable(failure.status):
+                            retry.add_bulk_lines(lines)
+                            reason = failure.error
+                        else:
+                            self.dead_letter(lines, failure.error)
+                            dead_lettered += 1
             except Exception as exc:
                 message = "Exception sending request '{}'"
                 print(message.format(str(exc)))
-                raise exc
+                retry, reason = buffer, str(exc)
+                throttled = throttled or attempt == 0
+
+            if retry.es_doc_count() == 0:
+                break
+            if attempt >= self.max_retries:
+                self.dead_letter(retry.body(), 'Gave up after {} retries: {}'.format(
+                    attempt, reason))
+                dead_lettered += retry.es_doc_count()
+                undelivered += retry.es_doc_count()
+                break
+            print('Retrying {} documents: {}'.format(retry.es_doc_count(), reason))
+            self._backoff(attempt)
+            attempt += 1
+            buffer = retry
+
+        result = first._asdict() if first else dict()
+        result['requests'] = 1
+        result['docs'] = docs
+        result['trigger'] = trigger
+        result['failed'] = failed
+        result['retries'] = attempt
+        result['dead_lettered'] = dead_lettered
+        result['undelivered'] = undelivered
+        result['duplicates'] = duplicates
+        result['rejected'] = rejected
+        result['throttled'] = throttled
+        if self.sizer:
+            self.sizer.observe(result)
+        with self._stats_lock:
+            for key in TOTAL_KEYS:
+                self._totals[key] += result[key]
+        return result
+
+    def _take_totals(self):
+        with self._stats_lock:
+            totals = self._totals
+            self._totals = dict.fromkeys(TOTAL_KEYS, 0)
+        return totals
+
+    def _send_in_background(self, buffer, trigger):
+        try:
+            return self._send(buffer, trigger)
+        finally:
+            self._slots.release()
+
+    def flush(self, trigger=TRIGGER_MANUAL, wait=True):
+        '''Flushes the line_buffer, sending all to the _bulk API. trigger names
+           the reason for the flush and is printed with the request.
+
+           In background mode, the buffer is handed to a sender thread and,
+           with wait=True, this blocks until every request in flight is done.
+
+           Returns (docs in the buffer, totals). In both modes, totals is None
+           unless wait is True. It is then a dict with the TOTAL_KEYS counts
+           (requests, docs, failed, ...) summed over every request that
+           finished since the last wait, including the ones flushed by
+           add_log_line.'''
+        before_doc_count = self.buffer.es_doc_count()
+        if not self._executor:
+            if before_doc_count > 0:
+                try:
+                    self._send(self.buffer, trigger)
+                    self.buffer.clear()
+                    self._started = None
+                except Exception as exc:
+                    message = "Exception sending request '{}'"
+                    print(message.format(str(exc)))
+                    raise exc
+            return (before_doc_count, self._take_totals() if wait else None)
+
+        if before_doc_count > 0:
+            buffer = self.buffer
+            self.buffer = self._new_buffer()
+            self._started = None
+            self._slots.acquire() # Blocks while max_in_flight requests are out
+            self._reap()
+            self._pending.append(
+                self._executor.submit(self._send_in_background, buffer, trigger))
+        if wait:
+            return (before_doc_count, self.wait())
         return (before_doc_count, None)
 
+    def _reap(self):
+        '''Drop the background requests that are done, so a long run doesn't
+           hold every result (and its _bulk response text) until the end. The
+           first exception is kept for wait() to raise.'''
+        pending = list()
+        for future in self._pending:
+            if not future.done():
+                pending.append(future)
+                continue
+            exc = future.exception()
+            if exc:
+                message = "Exception sending request '{}'"
+                print(message.format(str(exc)))
+                self._error = self._error or exc
+        self._pending = pending
+
+    def wait(self):
+        '''Block until every background request is done. Returns the totals
+           of the requests that finished since the last wait, as flush does.
+           If any request failed since the last wait, raises the first
+           exception once all have finished.'''
+        pending = self._pending
+        self._pending = list()
+        error = self._error
+        self._error = None
+        for future in pending:
+            try:
+                future.result()
+            except Exception as exc:
+                message = "Exception sending request '{}'"
+                print(message.format(str(exc)))
+                error = error or exc
+        if error:
+            raise error
+        return self._take_totals()
+
+    def close(self):
+        '''Send anything left in the buffer, wait for all requests and release
+           the sender threads and connections.'''
+        try:
+            self.flush(wait=True)
+        finally:
+            if self._executor:
+                self._executor.shutdown()
+            self.transport.close()
+
 
 class FlushingSQSBuffer():
     '''Use to send ES _bulk data to SQS in batches.'''
@@ -92,10 +366,11 @@ class FlushingSQSBuffer():
         return None
 
 
-def flushing_buffer_factory(descriptor, flush_trigger=1):
-    '''Call with a descriptor to receive a buffer object.'''
+def flushing_buffer_factory(descriptor, flush_trigger=1, **kwargs):
+    '''Call with a descriptor to receive a buffer object. Any other keyword
+       arguments are passed through to FlushingESBuffer.'''
     if isinstance(descriptor, ESDescriptor):
-        return FlushingESBuffer(descriptor, flush_trigger)
+        return FlushingESBuffer(descriptor, flush_trigger, **kwargs)
 
     if isinstance(descriptor, SQSDescriptor):
         return FlushingSQSBuffer(descriptor, flush_trigger)
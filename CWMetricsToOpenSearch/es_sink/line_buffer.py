@@ -7,10 +7,17 @@ Python 3
 Provides a buffer object that holds log lines in Elasticsearch _bulk
 format. As each line is added, the buffer stores the control line
 as well as the log line.
+
+ESLineBuffer holds the _bulk body as UTF-8 bytes in a single growing
+bytearray and tracks its sizes as lines are added, so measuring the buffer
+is O(1) and the transport can send it through a memoryview without joining
+or copying it.
 '''
 
 import abc
-import json
+from array import array
+
+from es_sink import serializer
 
 
 class LineBuffer():
@@ -22,13 +29,18 @@ class LineBuffer():
         self._line_buffer = list()
 
     @abc.abstractmethod
-    def add_line_dict(self, dic):
+    def add_line_dict(self, dic, doc_id=None):
         '''Children should add the log line to their internal buffer'''
 
     @abc.abstractmethod
-    def add_line_str(self, line):
+    def add_line_str(self, line, doc_id=None):
         '''Children should add the log line to their internal buffer'''
 
+    def add_line_bytes(self, line, doc_id=None):
+        '''Add a UTF-8 encoded log line. Children that store bytes should
+           override this to skip the decode.'''
+        self.add_line_str(line.decode('utf8'), doc_id)
+
     @abc.abstractmethod
     def es_docs(self):
         '''Children should override to return a multi-line string with only the
@@ -37,20 +49,30 @@ class LineBuffer():
     @staticmethod
     def _dict_to_string(dic):
         ''' Encode a dict as a string. Silently swallows errors '''
+        line = LineBuffer._dict_to_bytes(dic)
+        return line.decode('utf8')
+
+    @staticmethod
+    def _dict_to_bytes(dic):
+        ''' Encode a dict as UTF-8 JSON bytes with the shared serializer.
+            Silently swallows errors '''
         try:
-            line = json.JSONEncoder().encode(dic)
-            return line
-        except UnicodeDecodeError as exc:
-            msg = "unicode problem {}, skipping line: {}"
+            return serializer.dumps(dic)
+        except (UnicodeError, TypeError, ValueError) as exc:
+            msg = "encoding problem {}, skipping line: {}"
             print(msg.format(str(exc), dic))
-            return ''
+            return b''
 
-    def add_log_line(self, log_line):
-        '''Send all log lines to this function.'''
+    def add_log_line(self, log_line, doc_id=None):
+        '''Send all log lines to this function. doc_id, if given, is the
+           document's _id. Buffers that don't write to Elasticsearch ignore
+           it.'''
         if isinstance(log_line, dict):
-            self.add_line_dict(log_line)
+            self.add_line_dict(log_line, doc_id)
         elif isinstance(log_line, str):
-            self.add_line_str(log_line)
+            self.add_line_str(log_line, doc_id)
+        elif isinstance(log_line, (bytes, bytearray)):
+            self.add_line_bytes(log_line, doc_id)
         else:
             raise ValueError('{} is neither str nor dict'.format(log_line))
 
@@ -81,10 +103,10 @@ class SQSLineBuffer(LineBuffer):
     def __init__(self):
         super().__init__(self) # PyLint claims this is useless. Is it?
 
-    def add_line_str(self, line):
+    def add_line_str(self, line, doc_id=None):
         self._line_buffer.append(line)
 
-    def add_line_dict(self, dic):
+    def add_line_dict(self, dic, doc_id=None):
         line = LineBuffer._dict_to_string(dic)
         self._line_buffer.append(line)
 
@@ -98,31 +120,125 @@ class SQSLineBuffer(LineBuffer):
 
 
 class ESLineBuffer(LineBuffer):
-    '''Send lines to this class as either dicts or strs and it will buffer
-       a control line along with the log line. Use str() to retrieve the
-       post body to be used with a _bulk request.'''
+    '''Send lines to this class as either dicts, strs or UTF-8 bytes and it
+       will buffer a control line along with the log line. Use body() to
+       retrieve the post body to be used with a _bulk request.'''
 
-    def __init__(self, es_descriptor):
+    def __init__(self, es_descriptor, route_by_timestamp=False,
+                 index_in_url=False, action='index'):
         '''Initialize with the ES index name root as well as the ES type. These
-           are embedded in the control line.'''
+           are embedded in the control line. With route_by_timestamp, dicts
+           that carry an @timestamp go to the daily index for that timestamp
+           instead of today's.
+
+           With index_in_url, the buffer is meant to be posted to
+           bulk_url(url_index), where url_index is today's index when the
+           first line is added. Lines for that index get a bare action line
+           ({"index":{}}) and only lines for other indices carry _index.
+           action is the _bulk action, 'index' or 'create'. Use 'create' with
+           doc ids to make re-sends idempotent.'''
         super().__init__()
         self.es_descriptor = es_descriptor
-
-    def add_line_str(self, line):
+        self.route_by_timestamp = route_by_timestamp
+        self.index_in_url = index_in_url
+        self.action = action
+        self.url_index = None
+        self._body = bytearray()
+        self._offsets = array('Q')
+        self._doc_count = 0
+        self._docs_bytes = 0
+
+    def _append(self, data):
+        try:
+            self._body += data
+        except BufferError:
+            # A memoryview from body() is still alive (e.g. a failed send that
+            # was not cleared), so the bytearray can't grow in place. Move to a
+            # copy and leave the old one to the view.
+            self._body = bytearray(self._body)
+            self._body += data
+
+    def add_line_bytes(self, line, doc_id=None, index=None):
+        '''Buffer a UTF-8 encoded log line and an indexing command for that
+           line. doc_id sets the _id. index overrides the descriptor's index
+           for this line.'''
+        if self.index_in_url and self.url_index is None:
+            self.url_index = self.es_descriptor.index_name()
+        control_line = self.es_descriptor.bulk_action_line(
+            self.action, index, doc_id, self.url_index)
+        self._offsets.append(len(self._body))
+        self._append(control_line + line + b'\n')
+        self._doc_count += 1
+        self._docs_bytes += len(line) + 1
+
+    def add_bulk_lines(self, lines):
+        '''Buffer a control line and its log line, already encoded and new line
+           terminated, as returned by bulk_lines(). Used to re-send documents
+           from an earlier request as they were.'''
+        self._offsets.append(len(self._body))
+        self._append(lines)
+        self._doc_count += 1
+        self._docs_bytes += len(lines) - lines.index(b'\n') - 1
+
+    def bulk_lines(self, position):
+        '''Return the control line and log line for the document at position
+           (0-based) as bytes.'''
+        start = self._offsets[position]
+        end = len(self._body)
+        if position + 1 < len(self._offsets):
+            end = self._offsets[position + 1]
+        return bytes(memoryview(self._body)[start:end])
+
+    def add_line_str(self, line, doc_id=None):
         '''Buffer a log line and an indexing command for that line'''
-        control_line = self.es_descriptor.bulk_control_line()
-        self._line_buffer.append(control_line)
-        self._line_buffer.append(line)
+        self.add_line_bytes(line.encode('utf8'), doc_id)
+
+    def add_line_dict(self, dic, doc_id=None):
+        '''Buffer a log line and an indexing command for that line. The dict
+           is serialized straight to bytes.'''
+        line = LineBuffer._dict_to_bytes(dic)
+        if line:
+            self.add_doc_bytes(line, dic.get('@timestamp', None), doc_id)
+
+    def add_doc_bytes(self, line, timestamp=None, doc_id=None):
+        '''Buffer a document that is already serialized to UTF-8 JSON.
+           timestamp is its @timestamp, used to pick its daily index when
+           routing by timestamp.'''
+        index = None
+        if self.route_by_timestamp and timestamp is not None:
+            index = self.es_descriptor.index_name_for(timestamp)
+        self.add_line_bytes(line, doc_id, index)
+
+    def body(self):
+        '''Return the _bulk body as a memoryview over the buffer. No copy is
+           made, so don't hold on to it past clear().'''
+        return memoryview(self._body)
 
-    def add_line_dict(self, dic):
-        '''Buffer a log line and an indexing command for that line'''
-        line = LineBuffer._dict_to_string(dic)
-        self.add_line_str(line)
+    def clear(self):
+        '''Empty the buffer.'''
+        self._body = bytearray()
+        self._offsets = array('Q')
+        self._doc_count = 0
+        self._docs_bytes = 0
+        self.url_index = None
 
     def es_docs(self):
         '''Return just the log lines in the buffer.'''
-        return "\n".join(self._line_buffer[1::2]) + "\n"
+        lines = self._body.decode('utf8').split('\n')
+        return "\n".join(lines[1::2]) + "\n"
 
     def es_doc_count(self):
         '''Return the count of log lines in the buffer.'''
-        return len(self._line_buffer) / 2
+        return self._doc_count
+
+    def es_docs_bytes(self):
+        '''Return the byte count for the log lines in the buffer'''
+        return self._docs_bytes
+
+    def buffer_bytes(self):
+        '''Return the total size of the objects in the buffer. This includes
+           the size of the control lines.'''
+        return len(self._body)
+
+    def __str__(self):
+        return self._body.decode('utf8')
@@ -0,0 +1,112 @@
+'''
+Copyright 2020, Amazon Web Services Inc.
+This code is licensed under MIT license (see LICENSE.txt for details)
+
+Python 3
+
+Serializes documents to UTF-8 encoded JSON bytes, ready to go into a _bulk
+body. Uses orjson when it's installed, then ujson, and falls back to the
+standard library. The stdlib encoder is built once and reused.
+
+All backends produce compact JSON (no spaces after separators) with non-ASCII
+characters left as UTF-8, and write NaN and infinite floats as null, as
+orjson does. NaN is not valid JSON.
+
+orjson is optional and not in requirements.txt. Its wheels are built for one
+Python version and platform, so installing it on the build host doesn't give
+the Lambda runtime a module it can import. To use it, install the wheel for
+the Lambda's runtime into the function directory, e.g. for PYTHON_3_8 on
+x86_64:
+
+    pip install --target CWMetricsToOpenSearch/ --only-binary=:all: \
+        --platform manylinux2014_x86_64 --python-version 3.8 orjson
+
+Run this module to compare the per-document cost of the available backends
+against building a new JSONEncoder per document:
+
+    python -m es_sink.serializer
+'''
+
+import json
+import math
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+_ENCODER = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'),
+                            allow_nan=False)
+
+
+def _finite(obj):
+    '''Copy of obj with NaN and infinite floats replaced by None.'''
+    if isinstance(obj, float):
+        return obj if math.isfinite(obj) else None
+    if isinstance(obj, dict):
+        return {key: _finite(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_finite(value) for value in obj]
+    return obj
+
+
+def _stdlib_dumps(obj):
+    try:
+        return _ENCODER.encode(obj).encode('utf8')
+    except ValueError:
+        # Out of range float. Rare, so only these docs pay for the copy.
+        return _ENCODER.encode(_finite(obj)).encode('utf8')
+
+
+def _ujson_dumps(obj):
+    try:
+        return ujson.dumps(obj, ensure_ascii=False).encode('utf8')
+    except (OverflowError, ValueError):
+        return ujson.dumps(_finite(obj), ensure_ascii=False).encode('utf8')
+
+
+# dumps(obj) serializes obj to UTF-8 encoded JSON bytes.
+if orjson:
+    BACKEND = 'orjson'
+    dumps = orjson.dumps
+elif ujson:
+    BACKEND = 'ujson'
+    dumps = _ujson_dumps
+else:
+    BACKEND = 'json'
+    dumps = _stdlib_dumps
+
+
+def dumps_str(obj):
+    '''Serialize obj to a JSON str.'''
+    return dumps(obj).decode('utf8')
+
+
+def benchmark(count=100000):
+    '''Time count serializations of a metric document with each backend.'''
+    import timeit
+    doc = {'region': 'us-east-1', 'domain_name': 'my-domain',
+           'metric_name': 'CPUUtilization', 'stat': 'Maximum',
+           'CPUUtilization': 42.5, '@timestamp': '2024-01-01T00:00:00+00:00'}
+    candidates = [('JSONEncoder per doc (old)',
+                   lambda: json.JSONEncoder().encode(doc).encode('utf8')),
+                  ('json.dumps', lambda: json.dumps(doc).encode('utf8')),
+                  ('json, shared encoder', lambda: _stdlib_dumps(doc))]
+    if ujson:
+        candidates.append(('ujson', lambda: _ujson_dumps(doc)))
+    if orjson:
+        candidates.append(('orjson', lambda: orjson.dumps(doc)))
+    print('Serializing {} docs, active backend: {}'.format(count, BACKEND))
+    for name, func in candidates:
+        took = min(timeit.repeat(func, number=count, repeat=3))
+        print('{:28} {:8.3f} us/doc'.format(name, took / count * 1e6))
+
+
+if __name__ == '__main__':
+    benchmark()
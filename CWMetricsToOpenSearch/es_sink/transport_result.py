@@ -18,5 +18,9 @@ Python 3
 
 from collections import namedtuple
 
+# size is the size of the request body before compression, wire_size the size
+# actually sent. They are the same for uncompressed requests. wire_size is None
+# when the transport doesn't know it.
 TransportResult = namedtuple('TransportResult', ['status', 'result_text',
-                                                 'took_s', 'size'])
+                                                 'took_s', 'size', 'wire_size'],
+                             defaults=(None,))
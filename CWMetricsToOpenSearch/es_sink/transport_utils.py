@@ -18,10 +18,14 @@ from dateutil import tz
 from pytz import timezone
 
 
+UTC = timezone('UTC')
+PACIFIC = timezone('US/Pacific')
+
+
 def now_pst():
     '''Return the current time in PST timezone'''
-    now_utc = datetime.now(timezone('UTC'))
-    return now_utc.astimezone(timezone('US/Pacific'))
+    now_utc = datetime.now(UTC)
+    return now_utc.astimezone(PACIFIC)
 
 
 def utc_to_local_datetime(timestamp):
@@ -73,11 +77,17 @@ def flatten(current, key, result):
 
 def valid_request_body(body):
     ''' Helper function to ensure request bodies terminate with a new line
-        and to replace None with the empty string.'''
-    if body and not body.endswith("\n"):
-        body += "\n"
-    elif not body:
-        body = ""
+        and to replace None with the empty string. Bytes-like bodies (bytes,
+        bytearray, memoryview) are passed through uncopied when they already
+        end with a new line.'''
+    if not body:
+        return ""
+    if isinstance(body, str):
+        if not body.endswith("\n"):
+            body += "\n"
+        return body
+    if body[-1:] != b"\n":
+        body = bytes(body) + b"\n"
     return body
 
 
@@ -3,21 +3,31 @@ Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 SPDX-License-Identifier: MIT-0
 '''
 
-from collections import namedtuple
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import calendar
 from datetime import datetime, timedelta
-from dateutil import tz, parser
 import itertools
 import json
+from operator import attrgetter
 import os
+import queue
+import threading
 import time
-import uuid
 
 
-import boto3
 from es_sink.descriptor import ESDescriptor, IndexDescriptor
 import es_sink.es_auth
 from es_sink.es_transport import ESTransport
 import es_sink.flushing_buffer
+from es_sink.adaptive_sizing import AdaptiveBatchSizer
+from es_sink.doc_ids import DocIdFactory
+from es_sink.flush_policy import FlushPolicy
+from checkpoint_store import CheckpointStore
+from client_pool import ClientPool
+from metric_batch import MetricBatch
+from metric_catalog import MetricCatalog, DynamoDBCatalogStore, FileCatalogStore
+from metric_policy import MetricPolicy, field_collision, rollup_expression
 
 # Lambda Interval Settings (seconds)
 LAMBDA_INTERVAL=60
@@ -44,6 +54,17 @@ SingleMetricValueCollection = namedtuple('SingleMetricValue',
                                          ('region', 'collection_name', 'collection_id', 'index_name', 'metric_name', 'stat',
                                           'value', 'timestamp'))
 
+# Where the results of a GetMetricData query go. Built once per query, when
+# the query is, so handling a result is a lookup by its Id. record_type and
+# fields build the values, target is the name of the domain or collection that
+# owns the query and series names the metric and stat in the seen set.
+MetricRoute = namedtuple('MetricRoute', ('record_type', 'fields', 'target',
+                                         'series'))
+
+def metric_route(record_type, fields, target):
+    return MetricRoute(record_type, fields, target,
+                       '|'.join(str(field) for field in fields.values()))
+
 
 ################################################################################
 # Environment
@@ -54,42 +75,221 @@ DOMAIN_ADMIN_UNAME = os.environ['DOMAIN_ADMIN_UNAME']
 DOMAIN_ADMIN_PW = os.environ['DOMAIN_ADMIN_PW']
 REGIONS = json.loads(os.environ['REGIONS'])
 SERVERLESS_REGIONS = json.loads(os.environ['SERVERLESS_REGIONS'])
-################################################################################
-# Timestamp tracking
 
-def get_last_timestamp_ddb(domain_name, region):
-    ddb = boto3.client('dynamodb')
+# Concurrency Settings. MAX_WORKERS bounds the number of AWS API calls in flight
+# across all regions, MAX_WORKERS_PER_REGION bounds them within a single region
+# so one busy region can't take the whole pool or trip its API throttling.
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', 16))
+MAX_WORKERS_PER_REGION = int(os.environ.get('MAX_WORKERS_PER_REGION', 4))
+# HTTP connection pool size for each boto3 client. Each regional client is
+# shared by up to MAX_WORKERS_PER_REGION threads.
+MAX_POOL_CONNECTIONS = int(os.environ.get('MAX_POOL_CONNECTIONS',
+                                          max(10, MAX_WORKERS_PER_REGION)))
+# Values stream from the CloudWatch threads to the _bulk buffer a page at a
+# time. At most STREAM_MAX_PAGES pages wait to be sent before the threads
+# pause, which bounds memory whatever the number of domains.
+STREAM_MAX_PAGES = int(os.environ.get('STREAM_MAX_PAGES', 16))
+
+# Retrieval window settings. CloudWatch publishes points a few minutes late, so
+# only points older than SETTLE_S seconds are settled. Each run reads from the
+# settled watermark left by the last run, so the unsettled tail is read again,
+# and points already sent from it are dropped. SEEN_SET picks where the record
+# of sent points is kept: "ddb" (with the timestamps) or "memory" (warm
+# invocations only). With "memory", every cold start and every overlapping
+# invocation sends up to SETTLE_S seconds of points again, so pair it with
+# BULK_DOC_IDS. Domains and collections with no timestamp yet start
+# INITIAL_LOOKBACK_S seconds back.
+SETTLE_S = int(os.environ.get('SETTLE_S', 180))
+SEEN_SET = os.environ.get('SEEN_SET', 'ddb')
+INITIAL_LOOKBACK_S = int(os.environ.get('INITIAL_LOOKBACK_S', 15 * 60))
+
+# Metric policy. A JSON document, inline in METRIC_POLICY or in the file at
+# METRIC_POLICY_PATH, choosing the metrics to retrieve and the stats for each
+# (see metric_policy.py). With neither, every metric is retrieved as Minimum,
+# Maximum and Average. Every metric's period is LAMBDA_INTERVAL, the step the
+# retrieval window moves by, and the policy can't set another. The policy can
+# also declare rollups, region-wide series aggregated by CloudWatch. Their
+# values are indexed with "*" in place of the domain or collection fields.
+METRIC_POLICY_JSON = os.environ.get('METRIC_POLICY', '')
+METRIC_POLICY_PATH = os.environ.get('METRIC_POLICY_PATH', '')
+
+# Metric Catalog Settings. METRIC_CATALOG picks where the list of metrics for
+# each domain/collection is cached between runs: "ddb" (the timestamp table),
+# "file" (METRIC_CATALOG_PATH), "memory" (warm invocations only) or "none".
+METRIC_CATALOG_MODE = os.environ.get('METRIC_CATALOG', 'ddb')
+METRIC_CATALOG_PATH = os.environ.get('METRIC_CATALOG_PATH', '/tmp/metric_catalog.json')
+METRIC_CATALOG_TTL = int(os.environ.get('METRIC_CATALOG_TTL', 3600))
+METRIC_CATALOG_JITTER = float(os.environ.get('METRIC_CATALOG_JITTER', 0.5))
+# How metrics are listed when the catalog has no live entry. "domain" sends a
+# list_metrics scan per domain or collection. "region" scans the AWS/ES and
+# AWS/AOSS namespaces once per region and splits the result by domain or
+# collection. METRIC_RECENTLY_ACTIVE (e.g. PT3H, the only value CloudWatch
+# takes) limits listings to metrics with recent data.
+METRIC_DISCOVERY = os.environ.get('METRIC_DISCOVERY', 'domain')
+METRIC_RECENTLY_ACTIVE = os.environ.get('METRIC_RECENTLY_ACTIVE', '')
+
+# Bulk Flush Settings. A buffer is sent when it holds FLUSH_MAX_DOCS docs or
+# FLUSH_MAX_BYTES bytes, or FLUSH_MAX_AGE_S seconds after its first doc went
+# in, whichever comes first. Keep FLUSH_MAX_BYTES below the monitoring domain's
+# http.max_content_length (10 MiB on the smallest instance types).
+FLUSH_MAX_DOCS = int(os.environ.get('FLUSH_MAX_DOCS', 1000))
+FLUSH_MAX_BYTES = int(os.environ.get('FLUSH_MAX_BYTES', 5 * 1024 * 1024))
+FLUSH_MAX_AGE_S = float(os.environ.get('FLUSH_MAX_AGE_S', 30))
+# Number of _bulk requests each buffer may have in flight in the background
+# while the handler keeps filling it. 0 sends synchronously.
+BULK_MAX_IN_FLIGHT = int(os.environ.get('BULK_MAX_IN_FLIGHT', 2))
+# Adaptive batch sizing. Batches grow or shrink (between BULK_MIN_DOCS and
+# BULK_MAX_DOCS docs, and up to FLUSH_MAX_BYTES bytes) to keep each _bulk
+# request close to BULK_TARGET_LATENCY_S seconds and back off on rejections.
+# Set BULK_TARGET_LATENCY_S to 0 to keep the batch size fixed.
+BULK_TARGET_LATENCY_S = float(os.environ.get('BULK_TARGET_LATENCY_S', 1.0))
+BULK_MIN_DOCS = int(os.environ.get('BULK_MIN_DOCS', 100))
+BULK_MAX_DOCS = int(os.environ.get('BULK_MAX_DOCS', 10000))
+# gzip _bulk request bodies. Off by default. The monitoring domain, and any
+# proxy in front of it, must accept gzip bodies (Amazon OpenSearch Service
+# does, with its default http.compression setting).
+BULK_GZIP = os.environ.get('BULK_GZIP', 'false').lower() == 'true'
+BULK_GZIP_LEVEL = int(os.environ.get('BULK_GZIP_LEVEL', 3))
+# Write each point to the daily index for its own @timestamp. When false, points
+# go to the index for the day they are sent, so late points fetched just after
+# midnight land in the next day's index.
+ROUTE_BY_TIMESTAMP = os.environ.get('ROUTE_BY_TIMESTAMP', 'true').lower() == 'true'
+# Leave _index out of the _bulk action lines of docs that go to the index named
+# in the _bulk url. Most metric docs are small, so this cuts the body a lot.
+BULK_INDEX_IN_URL = os.environ.get('BULK_INDEX_IN_URL', 'true').lower() == 'true'
+# Give each point a _id hashed from its series and timestamp and send it with
+# the _bulk "create" action. Points that are fetched again (e.g. after a run
+# that failed before writing its timestamps) are then rejected as version
+# conflicts instead of being indexed twice. This holds for every narrow doc,
+# but only partly for wide docs (see DOC_LAYOUT).
+BULK_DOC_IDS = os.environ.get('BULK_DOC_IDS', 'false').lower() == 'true'
+# Document layout. 'narrow' writes one doc per metric, stat and timestamp, with
+# the value in a field named for the metric. 'wide' writes one doc per domain
+# (or collection and index) and timestamp, with a field per metric and stat,
+# e.g. CPUUtilization.max. The two layouts map the metric fields differently,
+# so switching layout conflicts with the current day's indices. The alerts in
+# opensearch/create_alerts.sh and the shipped dashboards query the narrow
+# fields (ClusterStatus.red, CPUUtilization, ...), so they don't work with
+# 'wide'. With BULK_DOC_IDS, a wide doc's _id covers the set of metrics in
+# it, so a re-send only conflicts if it holds exactly the same metrics. A
+# re-send with a different subset, e.g. after a cold start with an in-memory
+# seen set, is indexed as another partial doc for the same timestamp.
+DOC_LAYOUT = os.environ.get('DOC_LAYOUT', 'narrow').lower()
+################################################################################
+# Worker pool
+
+# boto3 clients, built once per (service, region) and reused by every thread
+# and across warm invocations.
+CLIENTS = ClientPool(max_pool_connections=MAX_POOL_CONNECTIONS)
+
+
+REGION_SEMAPHORES = dict()
+REGION_SEMAPHORES_LOCK = threading.Lock()
+def region_semaphore(region):
+    with REGION_SEMAPHORES_LOCK:
+        sem = REGION_SEMAPHORES.get(region, None)
+        if not sem:
+            sem = threading.BoundedSemaphore(MAX_WORKERS_PER_REGION)
+            REGION_SEMAPHORES[region] = sem
+        return sem
+
+
+def fan_out(calls):
+    ''' calls is a list of (region, func, args) tuples. Runs every func(*args) on
+        a pool of at most MAX_WORKERS threads, with at most
+        MAX_WORKERS_PER_REGION running for any one region.
+        Returns the results in the same order as calls, regardless of the order
+        the calls finish in.
+    '''
+    if not calls:
+        return []
+
+    def run(call):
+        (region, func, args) = call
+        with region_semaphore(region):
+            return func(*args)
+
+    results = [None] * len(calls)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        futures = [(pos, pool.submit(run, calls[pos]))
+                   for pos in round_robin(calls)]
+        for pos, future in futures:
+            results[pos] = future.result()
+    return results
+
+
+def round_robin(calls):
+    ''' Returns the positions of calls, interleaved across regions. Submitting
+        in this order keeps the pool threads from all queueing up on the same
+        region's semaphore.'''
+    by_region = dict()
+    for pos, call in enumerate(calls):
+        by_region.setdefault(call[0], []).append(pos)
+    return [pos
+            for group in itertools.zip_longest(*by_region.values())
+            for pos in group if pos is not None]
+
+
+def fan_out_stream(calls, max_pending=STREAM_MAX_PAGES):
+    ''' Like fan_out, but each func(*args) returns an iterable. Yields the
+        items of every call as the threads produce them, in no particular
+        order. Threads block once max_pending items are waiting, until the
+        caller catches up. If a call raises, the exception is raised here
+        once the other calls are done.
+    '''
+    if not calls:
+        return
+
+    done = object()
+    pending = queue.Queue(maxsize=max_pending)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pending.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def run(call):
+        (region, func, args) = call
+        try:
+            with region_semaphore(region):
+                for item in func(*args):
+                    put(item)
+                    if stop.is_set():
+                        return
+        finally:
+            put(done)
+
+    pool = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    futures = [pool.submit(run, calls[pos]) for pos in round_robin(calls)]
     try:
-        ret = ddb.get_item(TableName=DDB_TABLE,
-                           Key={'domain': {'S': domain_name},
-                                'region': {'S': region}})
-        if not ret or not ret.get('Item', None):
-            return None
-        iso_ts = ret['Item'].get('Timestamp', None)
-        if not iso_ts:
-            return None
-        iso_ts = iso_ts['S']
-        return parser.parse(iso_ts)
-    except Exception as e:
-        print('Exception retrieving timestamp for "{}:{}"'.format(domain_name, region))
-        print(e)
-    return None
+        remaining = len(futures)
+        while remaining:
+            item = pending.get()
+            if item is done:
+                remaining -= 1
+            else:
+                yield item
+        for future in futures:
+            future.result()
+    finally:
+        # Unblocks the threads if the caller stops early
+        stop.set()
+        pool.shutdown(wait=True)
 
+################################################################################
+# Timestamp tracking
 
-def update_metric_timestamp_ddb(domain_name, region, ts):
-    ddb = boto3.client('dynamodb')
-    try:
-        existing = get_last_timestamp_ddb(domain_name, region)
-        if not existing or (existing and existing < ts):
-            ddb.update_item(
-                TableName=DDB_TABLE,
-                Key={ 'domain': {'S': domain_name},
-                      'region': {'S': region}},
-                AttributeUpdates={'Timestamp': { 'Value': {'S': ts.isoformat()}}}
-            )
-    except Exception as e:
-        print('Exception putting timestamp for "{}:{}"'.format(domain_name, region))
-        print(e)
+# Timestamps for every domain and collection are read in one go at the start
+# of a run and written back once the values have been sent.
+CHECKPOINTS = CheckpointStore(lambda: CLIENTS.client('dynamodb'), DDB_TABLE,
+                              persist_seen=SEEN_SET == 'ddb')
+if SEEN_SET != 'ddb' and not BULK_DOC_IDS:
+    print('SEEN_SET is "{}" and BULK_DOC_IDS is off: points are indexed again '
+          'after a cold start'.format(SEEN_SET))
 
 
 LAST_TIMESTAMPS = dict()
@@ -116,17 +316,24 @@ def list_all_domains():
         account in that region. Returns a list of domain names.
     '''
     print("Started processing for list_all_domains")
-    doms = {}
-    for region in REGIONS:
-        es = boto3.client('es', region)
-        try:
-            resp = es.list_domain_names()
-            resp = resp['DomainNames']
-            doms[region] = [val['DomainName'] for val in resp]
-        except Exception as e:
-            print('Failed to get domain names in region: {}'.format(region))
-            print(e)
-    return doms
+    listed = fan_out([(region, list_region_domains, (region,))
+                      for region in REGIONS])
+    return {region: names for region, names in zip(REGIONS, listed)
+            if names is not None}
+
+
+def list_region_domains(region):
+    ''' Returns the list of domain names in region, or None if the listing
+        failed.'''
+    es = CLIENTS.client('es', region)
+    try:
+        resp = es.list_domain_names()
+        resp = resp['DomainNames']
+        return [val['DomainName'] for val in resp]
+    except Exception as e:
+        print('Failed to get domain names in region: {}'.format(region))
+        print(e)
+    return None
 
 # Domain tracking;
 
@@ -135,17 +342,24 @@ def list_all_collections():
         account in that region. Returns a list of domain names.
     '''
     print("Started processing for list_all_collections")
-    cols = {}
-    for region in SERVERLESS_REGIONS:
-        aoss = boto3.client('opensearchserverless', region)
-        try:
-            resp = aoss.list_collections()
-            resp = resp['collectionSummaries']
-            cols[region] = [val['id'] for val in resp]
-        except Exception as e:
-            print('Failed to get domain names in region: {}'.format(region))
-            print(e)
-    return cols
+    listed = fan_out([(region, list_region_collections, (region,))
+                      for region in SERVERLESS_REGIONS])
+    return {region: ids for region, ids in zip(SERVERLESS_REGIONS, listed)
+            if ids is not None}
+
+
+def list_region_collections(region):
+    ''' Returns the list of collection ids in region, or None if the listing
+        failed.'''
+    aoss = CLIENTS.client('opensearchserverless', region)
+    try:
+        resp = aoss.list_collections()
+        resp = resp['collectionSummaries']
+        return [val['id'] for val in resp]
+    except Exception as e:
+        print('Failed to get domain names in region: {}'.format(region))
+        print(e)
+    return None
 
 ################################################################################
 # CloudWatch interface
@@ -156,7 +370,7 @@ def list_domain_cloudwatch_metrics(domain_name=None, region=None):
         all metrics.
         Returns a list of SingleMetricDescriptions
     '''
-    cw = boto3.client('cloudwatch', region)
+    cw = CLIENTS.client('cloudwatch', region)
     paginator = cw.get_paginator('list_metrics')
     iter = paginator.paginate(
         Dimensions=[
@@ -164,7 +378,8 @@ def list_domain_cloudwatch_metrics(domain_name=None, region=None):
                 'Name': 'DomainName',
                 'Value': domain_name
             }
-        ]
+        ],
+        **recently_active()
     )
     resp = []
     for page in iter:
@@ -180,7 +395,7 @@ def list_domain_cloudwatch_metrics_collections(collection_id=None, region=None):
         all metrics.
         Returns a list of SingleMetricDescriptions
     '''
-    cw = boto3.client('cloudwatch', region)
+    cw = CLIENTS.client('cloudwatch', region)
     paginator = cw.get_paginator('list_metrics')
     iter = paginator.paginate(
         Dimensions=[
@@ -188,7 +403,8 @@ def list_domain_cloudwatch_metrics_collections(collection_id=None, region=None):
                 'Name': 'CollectionId',
                 'Value': collection_id
             }
-        ]
+        ],
+        **recently_active()
     )
     resp = []
     for page in iter:
@@ -199,59 +415,175 @@ def list_domain_cloudwatch_metrics_collections(collection_id=None, region=None):
     return resp
 
 
+def recently_active():
+    ''' Extra list_metrics arguments for METRIC_RECENTLY_ACTIVE.'''
+    if METRIC_RECENTLY_ACTIVE:
+        return {'RecentlyActive': METRIC_RECENTLY_ACTIVE}
+    return {}
+
+
+def list_region_cloudwatch_metrics(region, namespace, dimension):
+    ''' Lists every metric in namespace in region with a single paginated scan
+        and splits them by the value of their dimension, e.g. DomainName.
+        Returns a dict of dimension value -> list of SingleMetricDescriptions.
+        Metrics without the dimension are left out.
+    '''
+    cw = CLIENTS.client('cloudwatch', region)
+    paginator = cw.get_paginator('list_metrics')
+    iter = paginator.paginate(Namespace=namespace, **recently_active())
+    resp = dict()
+    for page in iter:
+        for metric in page['Metrics']:
+            for dim in metric['Dimensions']:
+                if dim['Name'] == dimension:
+                    resp.setdefault(dim['Value'], []).append(
+                        SingleMetricDescription(metric_name=metric['MetricName'],
+                                                dims=metric['Dimensions']))
+                    break
+    return resp
+
+
+def describe_by_region(targets, namespace, dimension):
+    ''' Returns the metric descriptions for targets, a list of (region, name)
+        tuples, like METRIC_CATALOG.descriptions. Regions with targets that are
+        not in the catalog are listed once with list_region_cloudwatch_metrics.
+        Entries that expire in the meantime have their region listed then.
+    '''
+    regions = sorted(set(region for region, name in METRIC_CATALOG.stale(targets)))
+    print('Listing {} metrics in {} regions'.format(namespace, len(regions)))
+    listed = fan_out([(region, list_region_cloudwatch_metrics,
+                       (region, namespace, dimension))
+                      for region in regions])
+    by_region = dict(zip(regions, listed))
+
+    def from_region(name, region):
+        # An entry can expire between stale() and descriptions(), so its
+        # region may not have been listed yet.
+        if region not in by_region:
+            by_region[region] = list_region_cloudwatch_metrics(
+                region, namespace, dimension)
+        return by_region[region].get(name, [])
+
+    return [METRIC_CATALOG.descriptions(region, name, from_region)
+            for region, name in targets]
+
+
+def metric_catalog_store(mode):
+    if mode == 'ddb':
+        return DynamoDBCatalogStore(lambda: CLIENTS.client('dynamodb'), DDB_TABLE)
+    if mode == 'file':
+        return FileCatalogStore(METRIC_CATALOG_PATH)
+    return None
+
+
+METRIC_CATALOG = MetricCatalog(
+    SingleMetricDescription,
+    store=metric_catalog_store(METRIC_CATALOG_MODE),
+    ttl_s=0 if METRIC_CATALOG_MODE == 'none' else METRIC_CATALOG_TTL,
+    jitter=METRIC_CATALOG_JITTER)
+
+
 def get_all_domain_metric_descriptions(doms):
     ''' Takes a list of dicts - region: list of domains and retrieves the available
-        metrics for each of the domains.
+        metrics for each of the domains. Metrics come from the METRIC_CATALOG
+        when it has a live entry for the domain.
     '''
-    resp = []
-    for region, domains in doms.items():
-        for domain in domains:
-            dmets = list_domain_cloudwatch_metrics(domain_name=domain,
-                                                   region=region)
-            resp.append(DomainMetricsAvailable(region, domain, dmets))
-    return resp
+    targets = [(region, domain)
+               for region, domains in doms.items() for domain in domains]
+    METRIC_CATALOG.load(targets)
+    if METRIC_DISCOVERY == 'region':
+        listed = describe_by_region(targets, 'AWS/ES', 'DomainName')
+    else:
+        listed = fan_out([(region, METRIC_CATALOG.descriptions,
+                           (region, domain, list_domain_cloudwatch_metrics))
+                          for region, domain in targets])
+    METRIC_CATALOG.save()
+    return [DomainMetricsAvailable(region, domain, dmets)
+            for (region, domain), dmets in zip(targets, listed)]
 
 def get_all_domain_metric_descriptions_collections(colls):
     ''' Takes a list of dicts - region: list of collections and retrieves the available
-        metrics for each of the collections.
+        metrics for each of the collections. Metrics come from the METRIC_CATALOG
+        when it has a live entry for the collection.
     '''
-    resp = []
-    for region, collections in colls.items():
-        for collection in collections:
-            dmets = list_domain_cloudwatch_metrics_collections(collection_id=collection,
-                                                               region=region)
-            resp.append(CollectionMetricsAvailable(region, collection, dmets))
-    return resp
+    targets = [(region, collection)
+               for region, collections in colls.items() for collection in collections]
+    METRIC_CATALOG.load(targets)
+    if METRIC_DISCOVERY == 'region':
+        listed = describe_by_region(targets, 'AWS/AOSS', 'CollectionId')
+    else:
+        listed = fan_out([(region, METRIC_CATALOG.descriptions,
+                           (region, collection, list_domain_cloudwatch_metrics_collections))
+                          for region, collection in targets])
+    METRIC_CATALOG.save()
+    return [CollectionMetricsAvailable(region, collection, dmets)
+            for (region, collection), dmets in zip(targets, listed)]
+
+
+def load_metric_policy():
+    ''' Build the MetricPolicy from METRIC_POLICY_PATH or METRIC_POLICY.'''
+    text = METRIC_POLICY_JSON
+    if METRIC_POLICY_PATH:
+        with open(METRIC_POLICY_PATH) as f:
+            text = f.read()
+    return MetricPolicy.from_json(text, default_period=LAMBDA_INTERVAL)
+
+METRIC_POLICY = load_metric_policy()
+
+
+# GetMetricData query Ids only have to be unique within a call and start with
+# a lower case letter. They come from a counter, so they are short and cheap to
+# make.
+QUERY_IDS = itertools.count()
+
+def next_query_id():
+    return 'q{:x}'.format(next(QUERY_IDS))
 
 
 def build_metric_data_queries(domain_name, region, metric_descriptions):
+    ''' Returns the GetMetricData queries for one domain, along with a dict
+        mapping each query Id to the MetricRoute for its results.
+        METRIC_POLICY picks the metrics, stats and periods.'''
     ret = []
+    routes = dict()
     for md in metric_descriptions:
         metric_name = md.metric_name
-        for stat in ['Minimum', 'Maximum', 'Average']: # What flexibility does this need?
-            label = '{} {} {} {}'.format(domain_name, region, metric_name, stat)
-            _id = 'a' + str(uuid.uuid1()).lower().replace('-', '_')
+        settings = METRIC_POLICY.settings('AWS/ES', metric_name)
+        if not settings:
+            continue
+        for stat in settings.stats:
+            _id = next_query_id()
             ret.append(
                 {
                     'Id': _id,
-                    'Label': label,
                     'MetricStat': {
                         'Metric': {
                             'Namespace': 'AWS/ES',
                             'MetricName': metric_name,
                             'Dimensions': md.dims
                         },
-                        'Period': LAMBDA_INTERVAL, # ? any need to do more granular than 1 minute?
+                        'Period': settings.period,
                         'Stat': stat,
                     }
                 }
             )
-    return ret
+            routes[_id] = metric_route(SingleMetricValue,
+                                       {'domain_name': domain_name, 'region': region,
+                                        'metric_name': metric_name, 'stat': stat},
+                                       domain_name)
+    return ret, routes
 
 def build_metric_data_queries_collections(collection_id, region, metric_descriptions):
+    ''' Returns the GetMetricData queries for one collection, along with a dict
+        mapping each query Id to the MetricRoute for its results.
+        METRIC_POLICY picks the metrics, stats and periods.'''
     ret = []
+    routes = dict()
     for md in metric_descriptions:
         metric_name = md.metric_name
+        settings = METRIC_POLICY.settings('AWS/AOSS', metric_name)
+        if not settings:
+            continue
         collection_name = "N/A"
         index_name = "N/A"
         for dimensions in md.dims:
@@ -260,25 +592,87 @@ def build_metric_data_queries_collections(collection_id, region, metric_descript
             elif dimensions['Name'] == "IndexName":
                 index_name = dimensions['Value']
 
-        for stat in ['Minimum', 'Maximum', 'Average']: # What flexibility does this need?
-            label = '{} {} {} {} {} {}'.format(collection_id, collection_name, index_name, region, metric_name, stat)
-            _id = 'a' + str(uuid.uuid1()).lower().replace('-', '_')
+        for stat in settings.stats:
+            _id = next_query_id()
             ret.append(
                 {
                     'Id': _id,
-                    'Label': label,
                     'MetricStat': {
                         'Metric': {
                             'Namespace': 'AWS/AOSS',
                             'MetricName': metric_name,
                             'Dimensions': md.dims
                         },
-                        'Period': LAMBDA_INTERVAL, # ? any need to do more granular than 1 minute?
+                        'Period': settings.period,
                         'Stat': stat,
                     }
                 }
             )
-    return ret
+            routes[_id] = metric_route(SingleMetricValueCollection,
+                                       {'collection_id': collection_id,
+                                        'collection_name': collection_name,
+                                        'index_name': index_name, 'region': region,
+                                        'metric_name': metric_name, 'stat': stat},
+                                       collection_id)
+    return ret, routes
+
+
+# Domain name, collection name, etc. of rollup values
+ROLLUP_NAME = '*'
+
+def build_rollup_queries(region, rollups, record_type, fields, target):
+    ''' Returns the Metric Math queries for rollups in one region, along with
+        their routes, as build_metric_data_queries does. fields has the record
+        fields that name a domain or collection.'''
+    ret = []
+    routes = dict()
+    for rollup in rollups:
+        _id = next_query_id()
+        ret.append(
+            {
+                'Id': _id,
+                'Label': rollup.name,
+                'Expression': rollup_expression(rollup),
+            }
+        )
+        route_fields = dict(fields)
+        route_fields.update(region=region, metric_name=rollup.name,
+                            stat=rollup.stat)
+        routes[_id] = metric_route(record_type, route_fields, target)
+    return ret, routes
+
+
+def rollup_targets(regions, namespace, record_type, fields, metric_names):
+    ''' Returns a MetricDataTarget per region for the rollups in namespace.
+        Their timestamps are kept under "rollups#<namespace>". Rollups whose
+        name can't share an index with one of metric_names, the metrics that
+        are retrieved, are skipped.'''
+    rollups = list()
+    field_names = set(metric_names)
+    for rollup in METRIC_POLICY.rollups(namespace):
+        collision = field_collision(rollup.name, field_names)
+        if collision:
+            print('Skipping rollup "{}": it collides with the {} field'.format(
+                rollup.name, collision))
+            continue
+        rollups.append(rollup)
+        field_names.add(rollup.name)
+
+    targets = list()
+    name = 'rollups#' + namespace
+    for region in regions:
+        queries, routes = build_rollup_queries(region, rollups, record_type,
+                                               fields, name)
+        if queries:
+            targets.append(MetricDataTarget(region, name, queries, routes))
+    return targets
+
+
+def retrieved_metrics(namespace, metric_names):
+    ''' The names in metric_names, as listed for namespace, that METRIC_POLICY
+        retrieves.'''
+    return [metric_name for metric_name in metric_names
+            if METRIC_POLICY.settings(namespace, metric_name)]
 
 
 def grouper(iterable, n):
@@ -290,130 +684,249 @@ def grouper(iterable, n):
         yield chunk
 
 
-def get_single_domain_metric_values(domain_name, region, metric_descriptions):
-    # TODO: Make this multi-domain?
-    ret = list()
-    cw = boto3.client('cloudwatch', region)
-    queries = build_metric_data_queries(domain_name, region, metric_descriptions)
+# GetMetricData accepts at most 500 queries per call.
+MAX_QUERIES_PER_REQUEST = 500
 
-    # The CW query runs from now to the last time this retrieved data. It could miss
-    # data points on edge case boundaries.
-    time_now = datetime.utcfromtimestamp(time.time())
-    last_timestamp = get_last_timestamp_ddb(domain_name, region)
-    if not last_timestamp:
-        last_timestamp = time_now - timedelta(minutes=15)
+# One domain or collection to fetch values for. name is the domain name or
+# collection id, which is also the key for its timestamp in DynamoDB.
+MetricDataTarget = namedtuple('MetricDataTarget',
+                              ('region', 'name', 'queries', 'routes'))
 
-    for group in grouper(queries, 100):
-        try:
-            paginator = cw.get_paginator('get_metric_data')
-            iter = paginator.paginate(MetricDataQueries=group,
-                                      StartTime=last_timestamp,
-                                      EndTime=time_now)
-            for page in iter:
-                for result in page['MetricDataResults']:
-                    # TODO: Error handling
-                    (result_domain, result_region, metric_name, stat) = result['Label'].split(' ')
-                    for val in zip(result['Timestamps'], result['Values']):
-                        ts = val[0].replace(microsecond=0, tzinfo=tz.tzutc())
-                        ret.append(SingleMetricValue(
-                            domain_name=result_domain,
-                            region=result_region,
-                            metric_name=metric_name,
-                            stat=stat,
-                            timestamp=ts.isoformat(),
-                            value=val[1]
-                        ))
-            update_metric_timestamp_ddb(domain_name, region, time_now)
-        except Exception as e:
-            # Handle me better
-            print('Exception', domain_name, region)
-            print(e)
-            print()
-    return ret
-
-def get_single_domain_metric_values_collections(collection_id, region, metric_descriptions):
-    # TODO: Make this multi-domain?
-    ret = list()
-    cw = boto3.client('cloudwatch', region)
-    queries = build_metric_data_queries_collections(collection_id, region, metric_descriptions)
-    # The CW query runs from now to the last time this retrieved data. It could miss
-    # data points on edge case boundaries.
+# A single GetMetricData call. targets lists the names of the domains or
+# collections that have queries in the batch, so their timestamps can be
+# advanced to settled_time once the batch is retrieved.
+MetricDataBatch = namedtuple('MetricDataBatch',
+                             ('region', 'start_time', 'end_time', 'queries',
+                              'routes', 'targets', 'settled_time'))
+
+
+def settled_time(time_now):
+    ''' The watermark for a run at time_now: SETTLE_S seconds back, on the
+        minute.'''
+    return (time_now - timedelta(seconds=SETTLE_S)).replace(second=0,
+                                                            microsecond=0)
+
+
+def plan_metric_data_batches(targets, last_timestamps, time_now):
+    ''' Packs the queries for all targets into as few GetMetricData calls as
+        possible. A call covers a single region and time window, so targets are
+        grouped by (region, last timestamp) and each group is filled up to
+        MAX_QUERIES_PER_REQUEST queries. A target's queries stay in a single
+        batch unless there are too many of them to fit in one.
+        Returns a list of MetricDataBatches.
+    '''
+    routes = dict()
+    groups = dict()
+    settled = settled_time(time_now)
+    for target, last_timestamp in zip(targets, last_timestamps):
+        routes.update(target.routes)
+        # The CW query runs from the settled watermark to now.
+        if not last_timestamp:
+            last_timestamp = time_now - timedelta(seconds=INITIAL_LOOKBACK_S)
+        groups.setdefault((target.region, last_timestamp), []).append(target)
+
+    batches = list()
+    for (region, start_time), group in groups.items():
+        queries = list()
+        names = list()
+
+        def emit():
+            batches.append(MetricDataBatch(region, start_time, time_now,
+                                           queries, routes, names, settled))
+
+        for target in group:
+            if queries and len(queries) + len(target.queries) > MAX_QUERIES_PER_REQUEST:
+                emit()
+                queries, names = list(), list()
+            for chunk in grouper(target.queries, MAX_QUERIES_PER_REQUEST):
+                if len(queries) + len(chunk) > MAX_QUERIES_PER_REQUEST:
+                    emit()
+                    queries, names = list(), list()
+                queries.extend(chunk)
+                names.append(target.name)
+        if queries:
+            emit()
+    return batches
+
+
+class TargetProgress():
+    ''' Counts the GetMetricData calls still to succeed for each target. A
+        target with more than MAX_QUERIES_PER_REQUEST queries is split across
+        calls, and its timestamp may only advance once all of them have
+        succeeded. Safe to share between threads.'''
+
+    def __init__(self, batches):
+        self._outstanding = Counter((batch.region, name)
+                                    for batch in batches for name in batch.targets)
+        self._failed = set()
+        self._lock = threading.Lock()
+
+    def succeeded(self, batch):
+        ''' Record that batch was retrieved. Advances the timestamps of its
+            targets that have no calls left, unless one of them failed.'''
+        for name in batch.targets:
+            key = (batch.region, name)
+            with self._lock:
+                self._outstanding[key] -= 1
+                ready = self._outstanding[key] == 0 and key not in self._failed
+            if ready:
+                CHECKPOINTS.advance(name, batch.region, batch.settled_time)
+
+    def failed(self, batch):
+        ''' Record that batch failed, so its targets' timestamps stay put.'''
+        with self._lock:
+            self._failed.update((batch.region, name) for name in batch.targets)
+
+
+def get_metric_data_batch(batch, record_type, by_page=True, progress=None):
+    ''' Sends one GetMetricData call and turns its results into metric values,
+        using the batch's routes to find the domain or collection for each
+        result. Yields a MetricBatch of record_type per page of results, or
+        with by_page=False, one for the whole call. Points that were sent by
+        an earlier run are dropped. Once every page has been read, the call
+        is reported to progress, a TargetProgress, which advances the
+        timestamps of the batch's targets to the settled time.'''
+    cw = CLIENTS.client('cloudwatch', batch.region)
+    values = MetricBatch(record_type)
+    settled = calendar.timegm(batch.settled_time.utctimetuple())
+    try:
+        paginator = cw.get_paginator('get_metric_data')
+        iter = paginator.paginate(MetricDataQueries=batch.queries,
+                                  StartTime=batch.start_time,
+                                  EndTime=batch.end_time)
+        for page in iter:
+            for result in page['MetricDataResults']:
+                # TODO: Error handling
+                route = batch.routes[result['Id']]
+                timestamps = result['Timestamps']
+                vals = result['Values']
+                positions = CHECKPOINTS.unseen(
+                    route.target, batch.region, route.series,
+                    [int(ts.timestamp()) for ts in timestamps], settled)
+                if len(positions) < len(timestamps):
+                    timestamps = [timestamps[pos] for pos in positions]
+                    vals = [vals[pos] for pos in positions]
+                series = values.series(result['Id'], route.fields)
+                values.extend(series, timestamps, vals)
+            if by_page and len(values):
+                yield values
+                values = MetricBatch(record_type)
+        if len(values):
+            yield values
+        if progress:
+            progress.succeeded(batch)
+    except Exception as e:
+        if progress:
+            progress.failed(batch)
+        # Handle me better
+        print('Exception', batch.region, batch.targets)
+        print(e)
+        print()
+
+
+def get_all_target_metric_values(targets, record_type):
+    ''' Targets is a list of MetricDataTargets. Retrieves the values for all of
+        them, batching queries across targets in the same region.
+        Yields MetricBatches of record_type as the pages come in. The wide
+        layout needs all of a target's values at once, so it gets a
+        MetricBatch per GetMetricData call instead. A call holds all of a
+        target's queries unless there are more than MAX_QUERIES_PER_REQUEST
+        of them.'''
     time_now = datetime.utcfromtimestamp(time.time())
-    last_timestamp = get_last_timestamp_ddb(collection_id, region)
-    if not last_timestamp:
-        last_timestamp = time_now - timedelta(minutes=15)
+    CHECKPOINTS.load([(target.name, target.region) for target in targets])
+    last_timestamps = [CHECKPOINTS.get(target.name, target.region)
+                       for target in targets]
+    batches = plan_metric_data_batches(targets, last_timestamps, time_now)
+    print('Retrieving {} queries for {} targets in {} GetMetricData calls'.format(
+        sum(len(batch.queries) for batch in batches), len(targets), len(batches)))
 
-    for group in grouper(queries, 100):
-        try:
-            paginator = cw.get_paginator('get_metric_data')
-            iter = paginator.paginate(MetricDataQueries=group,
-                                      StartTime=last_timestamp,
-                                      EndTime=time_now)
-            for page in iter:
-                for result in page['MetricDataResults']:
-                    # TODO: Error handling
-                    (collection_id, collection_name, index_name, region, metric_name, stat) = result['Label'].split(' ')
-                    for val in zip(result['Timestamps'], result['Values']):
-                        ts = val[0].replace(microsecond=0, tzinfo=tz.tzutc())
-                        ret.append(SingleMetricValueCollection(
-                            collection_id=collection_id,
-                            collection_name=collection_name,
-                            index_name=index_name,
-                            region=region,
-                            metric_name=metric_name,
-                            stat=stat,
-                            timestamp=ts.isoformat(),
-                            value=val[1]
-                        ))
-            update_metric_timestamp_ddb(collection_id, region, time_now)
-        except Exception as e:
-            # Handle me better
-            print('Exception', collection_id, region)
-            print(e)
-            print()
-    return ret
+    by_page = DOC_LAYOUT != 'wide'
+    progress = TargetProgress(batches)
+    yield from fan_out_stream([(batch.region, get_metric_data_batch,
+                                (batch, record_type, by_page, progress))
+                               for batch in batches])
 
 
 def get_all_domain_metric_values(domains):
     ''' Domains is a list of DomainMetricDescriptions - tuples with domain_name,
         region, and a list of SingleMetricDescriptions.
-        Returns a list of SingleMetricValues.
+        Yields MetricBatches of SingleMetricValues.
     '''
-    # TODO: Send a single request rather than 1 per domain/region dimension
-    res = list()
+    targets = list()
     for domain in domains:
-        domain_name = domain.domain_name
-        region = domain.region
-        res.extend(get_single_domain_metric_values(domain_name, region, domain.metric_descriptions))
-    return res
+        queries, routes = build_metric_data_queries(domain.domain_name, domain.region,
+                                                    domain.metric_descriptions)
+        targets.append(MetricDataTarget(domain.region, domain.domain_name,
+                                        queries, routes))
+    regions = sorted(set(domain.region for domain in domains))
+    metric_names = set(md.metric_name for domain in domains
+                       for md in domain.metric_descriptions)
+    targets.extend(rollup_targets(regions, 'AWS/ES', SingleMetricValue,
+                                  {'domain_name': ROLLUP_NAME},
+                                  retrieved_metrics('AWS/ES', metric_names)))
+    return get_all_target_metric_values(targets, SingleMetricValue)
 
 
 def get_all_domain_metric_values_collections(collections):
     ''' Collections is a list of CollectionMetricDescriptions - tuples with collection_id,
         region, and a list of SingleMetricDescriptions.
-        Returns a list of SingleMetricValuesCollections.
+        Yields MetricBatches of SingleMetricValuesCollections.
     '''
-    # TODO: Send a single request rather than 1 per domain/region dimension
-    res = list()
+    targets = list()
     for collection in collections:
-        collection_id = collection.collection_id
-        region = collection.region
-        res.extend(get_single_domain_metric_values_collections(collection_id, region, collection.metric_descriptions))
-    return res
+        queries, routes = build_metric_data_queries_collections(collection.collection_id,
+                                                                collection.region,
+                                                                collection.metric_descriptions)
+        targets.append(MetricDataTarget(collection.region, collection.collection_id,
+                                        queries, routes))
+    regions = sorted(set(collection.region for collection in collections))
+    metric_names = set(md.metric_name for collection in collections
+                       for md in collection.metric_descriptions)
+    targets.extend(rollup_targets(regions, 'AWS/AOSS', SingleMetricValueCollection,
+                                  {'collection_id': ROLLUP_NAME,
+                                   'collection_name': ROLLUP_NAME,
+                                   'index_name': ROLLUP_NAME},
+                                  retrieved_metrics('AWS/AOSS', metric_names)))
+    return get_all_target_metric_values(targets, SingleMetricValueCollection)
 
 
 ################################################################################
 # Amazon OpenSearch interface
 ES_AUTH = es_sink.es_auth.ESHttpAuth(DOMAIN_ADMIN_UNAME, DOMAIN_ADMIN_PW)
 
+def new_bulk_buffer(descriptor):
+    ''' Build a flushing buffer for descriptor with the bulk settings from the
+        environment. Each buffer gets its own policy, so their sizes adapt
+        independently.'''
+    policy = FlushPolicy(max_docs=FLUSH_MAX_DOCS,
+                         max_bytes=FLUSH_MAX_BYTES,
+                         max_age_s=FLUSH_MAX_AGE_S)
+    sizer = None
+    if BULK_TARGET_LATENCY_S > 0:
+        sizer = AdaptiveBatchSizer(policy,
+                                   target_latency_s=BULK_TARGET_LATENCY_S,
+                                   min_docs=BULK_MIN_DOCS,
+                                   max_docs=BULK_MAX_DOCS)
+    return es_sink.flushing_buffer.flushing_buffer_factory(
+        descriptor,
+        flush_policy=policy,
+        sizer=sizer,
+        compress=BULK_GZIP,
+        compresslevel=BULK_GZIP_LEVEL,
+        max_in_flight=BULK_MAX_IN_FLIGHT,
+        pool_size=max(10, BULK_MAX_IN_FLIGHT),
+        route_by_timestamp=ROUTE_BY_TIMESTAMP,
+        index_in_url=BULK_INDEX_IN_URL,
+        action='create' if BULK_DOC_IDS else 'index')
+
 INDEX_DESCRIPTOR = IndexDescriptor(es_index='domains', es_v7=True, timestamped=True)
 ES_DESCRIPTOR = ESDescriptor(
     endpoint=DOMAIN_ENDPOINT,
     index_descriptor=INDEX_DESCRIPTOR,
     auth=ES_AUTH
 )
-ES_BUFFER = es_sink.flushing_buffer.flushing_buffer_factory(ES_DESCRIPTOR,
-                                                            flush_trigger=1000)
+ES_BUFFER = new_bulk_buffer(ES_DESCRIPTOR)
+DOC_IDS = DocIdFactory(INDEX_DESCRIPTOR.es_index)
 
 INDEX_DESCRIPTOR_COLLECTIONS = IndexDescriptor(es_index='collections', es_v7=True, timestamped=True)
 ES_DESCRIPTOR_COLLECTIONS = ESDescriptor(
@@ -421,72 +934,170 @@ ES_DESCRIPTOR_COLLECTIONS = ESDescriptor(
     index_descriptor=INDEX_DESCRIPTOR_COLLECTIONS,
     auth=ES_AUTH
 )
-ES_BUFFER_COLLECTIONS=es_sink.flushing_buffer.flushing_buffer_factory(ES_DESCRIPTOR_COLLECTIONS,
-                                                                      flush_trigger=1000)
+ES_BUFFER_COLLECTIONS = new_bulk_buffer(ES_DESCRIPTOR_COLLECTIONS)
+DOC_IDS_COLLECTIONS = DocIdFactory(INDEX_DESCRIPTOR_COLLECTIONS.es_index)
+
+# Short names for stats in wide docs. Other stats, e.g. p99, are lowercased.
+STAT_FIELD_NAMES = {'Minimum': 'min', 'Maximum': 'max', 'Average': 'avg',
+                    'Sum': 'sum', 'SampleCount': 'count'}
+
+# Fields that identify the domain or collection in wide docs
+DOMAIN_KEY_FIELDS = ('region', 'domain_name')
+COLLECTION_KEY_FIELDS = ('region', 'collection_name', 'collection_id', 'index_name')
+
+# Fields that identify a series when hashing doc ids for narrow docs
+DOMAIN_ID_FIELDS = ('region', 'domain_name', 'metric_name', 'stat')
+COLLECTION_ID_FIELDS = ('region', 'collection_id', 'index_name', 'metric_name', 'stat')
+
+def pivot_metric_values(values, key_fields):
+    ''' Merge the values that share key_fields and a timestamp into one wide
+        doc. Returns a dict of (key fields..., timestamp) -> doc.'''
+    get_key = attrgetter(*key_fields)
+    field_names = dict()
+    docs = dict()
+    for value in values:
+        key = get_key(value) + (value.timestamp,)
+        doc = docs.get(key, None)
+        if doc is None:
+            doc = dict(zip(key_fields, key))
+            doc['@timestamp'] = value.timestamp
+            docs[key] = doc
+        field = field_names.get((value.metric_name, value.stat), None)
+        if field is None:
+            field = '{}.{}'.format(value.metric_name,
+                                   STAT_FIELD_NAMES.get(value.stat, value.stat.lower()))
+            field_names[(value.metric_name, value.stat)] = field
+        doc[field] = value.value
+    return docs
+
+
+def send_wide_docs(buffer, doc_ids, values, key_fields):
+    ''' Pivot values into wide docs and add them to buffer. Returns the number
+        of docs added and the number flushed.'''
+    total_flushed = 0
+    docs = pivot_metric_values(values, key_fields)
+    for key, doc in docs.items():
+        doc_id = None
+        if BULK_DOC_IDS:
+            # A doc may only hold some of the metrics for its timestamp, e.g.
+            # the ones a re-read of the unsettled tail found new, or the ones
+            # in one of several GetMetricData calls. The metric fields go
+            # into the _id so those docs don't collide with each other.
+            metrics = tuple(sorted(field for field in doc
+                                   if field not in key_fields and field != '@timestamp'))
+            doc_id = doc_ids.doc_id(key[:-1] + metrics, key[-1])
+        f, ignore = buffer.add_log_line(doc, doc_id)
+        total_flushed += f
+    return (len(docs), total_flushed)
+
 
 def send_all_domain_metric_values(values):
+    ''' values is an iterable of MetricBatches, e.g. as streamed by
+        get_all_domain_metric_values. Each one goes into the buffer as soon as
+        it arrives.'''
     total = 0
+    total_docs = 0
     total_flushed = 0
-    for value in values:
-
-        d = value._asdict()
-        line_value = d.pop('value')
-        metric_name = d['metric_name']
-        d[metric_name] = line_value
-
-        # Rename field timestamp to @timestamp
-        timestamp_value = d.pop('timestamp')
-        d['@timestamp'] = timestamp_value
-
-        log_line = json.dumps(d)
-
-        f, ignore = ES_BUFFER.add_log_line(log_line)
-
-        total_flushed += f
-        total += 1
-
-    print('Added {} log lines to the domain buffer'.format(total))
+    for page in values:
+        if DOC_LAYOUT == 'wide':
+            docs, flushed = send_wide_docs(ES_BUFFER, DOC_IDS, page,
+                                           DOMAIN_KEY_FIELDS)
+        else:
+            # Each value becomes a document with the series fields, the value
+            # in a field named for the metric and @timestamp. MetricBatch
+            # encodes them straight to bytes.
+            docs = len(page)
+            flushed = page.write(ES_BUFFER, DOC_IDS if BULK_DOC_IDS else None,
+                                 id_fields=DOMAIN_ID_FIELDS)
+        total += len(page)
+        total_docs += docs
+        total_flushed += flushed
+
+    print('Added {} log lines ({} values) to the domain buffer'.format(
+        total_docs, total))
     print('Flushed {} log lines for domains'.format(total_flushed))
 
 
 def send_all_domain_metric_values_collections(vals_collections):
+    ''' vals_collections is an iterable of MetricBatches, e.g. as streamed by
+        get_all_domain_metric_values_collections.'''
     total = 0
+    total_docs = 0
     total_flushed = 0
-    for value in vals_collections:
-
-        d = value._asdict()
-        line_value = d.pop('value')
-        metric_name = d['metric_name']
-        d[metric_name] = line_value
-
-        # Rename field timestamp to @timestamp
-        timestamp_value = d.pop('timestamp')
-        d['@timestamp'] = timestamp_value
-
-        log_line = json.dumps(d)
-
-        f, ignore = ES_BUFFER_COLLECTIONS.add_log_line(log_line)
+    for page in vals_collections:
+        if DOC_LAYOUT == 'wide':
+            docs, flushed = send_wide_docs(ES_BUFFER_COLLECTIONS,
+                                           DOC_IDS_COLLECTIONS, page,
+                                           COLLECTION_KEY_FIELDS)
+        else:
+            docs = len(page)
+            flushed = page.write(
+                ES_BUFFER_COLLECTIONS,
+                DOC_IDS_COLLECTIONS if BULK_DOC_IDS else None,
+                id_fields=COLLECTION_ID_FIELDS)
+        total += len(page)
+        total_docs += docs
+        total_flushed += flushed
+
+    print('Added {} log lines ({} values) to the collections buffer'.format(
+        total_docs, total))
+    print('Flushed {} log lines for collections'.format(total_flushed))
 
-        total_flushed += f
-        total += 1
 
-    print('Added {} log lines to the collections buffer'.format(total))
-    print('Flushed {} log lines for collections'.format(total_flushed))
+def flush_bulk_buffers(buffers):
+    ''' Send what is left in buffers and wait for every _bulk request in
+        flight. Returns False if any docs were not delivered: a request
+        failed as a whole, or its retries ran out.'''
+    delivered = True
+    for buffer in buffers:
+        url = buffer.target_descriptor.base_url_with_index()
+        try:
+            count, totals = buffer.flush(wait=True)
+            if totals['undelivered']:
+                print('{} docs were not delivered to {}'.format(
+                    totals['undelivered'], url))
+                delivered = False
+        except Exception as e:
+            print('Exception flushing {}'.format(url))
+            print(e)
+            delivered = False
+        print('Sent {} bytes of _bulk bodies as {} bytes to {}'.format(
+            buffer.raw_bytes_sent, buffer.wire_bytes_sent, url))
+        buffer.raw_bytes_sent = buffer.wire_bytes_sent = 0
+    return delivered
+
+
+def commit_checkpoints(delivered):
+    ''' Write the run's timestamps if its values were delivered. Otherwise
+        drop them, along with the run's seen points, so the next run reads
+        the same window again.'''
+    if delivered:
+        CHECKPOINTS.flush(fan_out)
+    else:
+        print('Keeping the timestamps where they were')
+        CHECKPOINTS.discard()
 ################################################################################
 # Lambda handler
 def handler(event, context):
-    doms = list_all_domains()
-    all_mets = get_all_domain_metric_descriptions(doms)
-    vals = get_all_domain_metric_values(all_mets)
-
-    colls = list_all_collections()
-    all_mets_collections = get_all_domain_metric_descriptions_collections(colls)
-    vals_collections = get_all_domain_metric_values_collections(all_mets_collections)
-
-    send_all_domain_metric_values(vals)
-    send_all_domain_metric_values_collections(vals_collections)
-
-    ES_BUFFER.flush()
+    try:
+        # Values are sent while they're still being retrieved, so the _bulk
+        # requests overlap the GetMetricData calls.
+        doms = list_all_domains()
+        all_mets = get_all_domain_metric_descriptions(doms)
+        send_all_domain_metric_values(get_all_domain_metric_values(all_mets))
+
+        colls = list_all_collections()
+        all_mets_collections = get_all_domain_metric_descriptions_collections(colls)
+        send_all_domain_metric_values_collections(
+            get_all_domain_metric_values_collections(all_mets_collections))
+    except Exception:
+        # The timestamps advanced in memory would outlive this invocation
+        CHECKPOINTS.discard()
+        raise
+
+    # Wait for everything in flight before the timestamps move forward.
+    commit_checkpoints(flush_bulk_buffers((ES_BUFFER, ES_BUFFER_COLLECTIONS)))
+    CLIENTS.report()
 
 
 ################################################################################
@@ -511,11 +1122,11 @@ if __name__ == '__main__':
 
     while 1:
         print('Retrieving metric values')
-        vals = get_all_domain_metric_values(all_mets)
-        print_all_vals(vals)
+        vals = list(get_all_domain_metric_values(all_mets))
+        print_all_vals(list(itertools.chain.from_iterable(vals)))
         print('Adding new metric values')
         send_all_domain_metric_values(vals)
-        ES_BUFFER.flush()
+        commit_checkpoints(flush_bulk_buffers((ES_BUFFER,)))
 
 
 def print_doms(doms):
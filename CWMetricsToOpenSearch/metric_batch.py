@@ -0,0 +1,128 @@
+'''
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+
+Columnar store for the metric values retrieved from CloudWatch. Holding one
+namedtuple per point repeats the region, domain and metric strings and an ISO
+timestamp string in every point. A MetricBatch keeps each series (the fields
+that identify a domain's or collection's metric and stat) once, and stores
+the points as three parallel arrays: series number, epoch seconds and value.
+
+Points are written to a _bulk buffer as NDJSON without building a dict per
+point. Each series keeps its document prefix, already encoded, and each
+timestamp is formatted once per batch.
+'''
+
+from array import array
+from datetime import datetime
+import math
+import threading
+
+from dateutil import tz
+
+from es_sink import serializer
+
+
+class MetricBatch():
+    ''' Metric values for many series. record_type is the namedtuple type that
+        iterating the batch yields, e.g. SingleMetricValue. Its fields, less
+        value and timestamp, are the series fields, in document order. Safe to
+        fill from several threads.'''
+
+    def __init__(self, record_type):
+        self.record_type = record_type
+        self._series_fields = tuple(field for field in record_type._fields
+                                    if field not in ('value', 'timestamp'))
+        self._series = list()
+        self._series_index = dict()
+        self._prefixes = list()
+        self._iso = dict()
+        self._point_series = array('L')
+        self._epochs = array('q')
+        self._values = array('d')
+        self._lock = threading.Lock()
+
+    def series(self, key, fields):
+        ''' Return the number of the series for key (e.g. a GetMetricData
+            query Id), adding it with fields, a dict holding the series
+            fields, if it's new.'''
+        with self._lock:
+            index = self._series_index.get(key, None)
+            if index is None:
+                index = len(self._series)
+                self._series_index[key] = index
+                self._series.append(tuple(fields[field]
+                                          for field in self._series_fields))
+                self._prefixes.append(None)
+            return index
+
+    def extend(self, series, timestamps, values):
+        ''' Add the points for one series. timestamps are datetimes, as
+            returned by GetMetricData, and values are floats.'''
+        epochs = [int(ts.timestamp()) for ts in timestamps]
+        with self._lock:
+            self._point_series.extend([series] * len(epochs))
+            self._epochs.extend(epochs)
+            self._values.extend(values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def _timestamp(self, epoch):
+        iso = self._iso.get(epoch, None)
+        if iso is None:
+            iso = datetime.fromtimestamp(epoch, tz.tzutc()).isoformat()
+            self._iso[epoch] = iso
+        return iso
+
+    def __iter__(self):
+        ''' Yield the points as record_type tuples.'''
+        for series, epoch, value in zip(self._point_series, self._epochs,
+                                        self._values):
+            yield self.record_type(*self._series[series], value=value,
+                                   timestamp=self._timestamp(epoch))
+
+    def _prefix(self, series):
+        ''' The encoded start of a document for series, up to the value:
+            {"region":...,"stat":"Maximum","<metric_name>": '''
+        prefix = self._prefixes[series]
+        if prefix is None:
+            fields = dict(zip(self._series_fields, self._series[series]))
+            prefix = (serializer.dumps(fields)[:-1] + b',' +
+                      serializer.dumps(fields['metric_name']) + b':')
+            self._prefixes[series] = prefix
+        return prefix
+
+    def write(self, buffer, doc_ids=None, id_fields=None):
+        ''' Add a document per point to buffer, a FlushingESBuffer. Documents
+            have the series fields, the value in a field named for the metric
+            and @timestamp. With doc_ids, a DocIdFactory, each document gets an
+            _id hashed from the id_fields of its series and its timestamp.
+            Returns the number of documents flushed along the way.'''
+        id_keys = dict()
+        encoded = dict()
+        flushed = 0
+        for series, epoch, value in zip(self._point_series, self._epochs,
+                                        self._values):
+            timestamp = self._timestamp(epoch)
+            encoded_ts = encoded.get(epoch, None)
+            if encoded_ts is None:
+                encoded_ts = b',"@timestamp":"' + timestamp.encode('ascii') + b'"}'
+                encoded[epoch] = encoded_ts
+            if math.isfinite(value):
+                encoded_value = repr(value).encode('ascii')
+            else:
+                encoded_value = b'null'
+            doc_id = None
+            if doc_ids:
+                key = id_keys.get(series, None)
+                if key is None:
+                    fields = dict(zip(self._series_fields, self._series[series]))
+                    key = tuple(fields[field] for field in id_fields)
+                    id_keys[series] = key
+                doc_id = doc_ids.doc_id(key, timestamp)
+            f, ignore = buffer.add_doc_bytes(
+                self._prefix(series) + encoded_value + encoded_ts,
+                timestamp=timestamp, doc_id=doc_id)
+            flushed += f
+        return flushed
@@ -0,0 +1,214 @@
+'''
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+
+Caches the list of CloudWatch metrics available for each domain and
+collection. The set of metrics for a domain only changes when its version or
+configuration changes, so there's no need to page through list_metrics for
+every domain on every run.
+
+Entries are keyed by (region, name), where name is the domain name or
+collection id. Each entry expires after a TTL that is shortened by a random
+jitter, so entries cached in the same run don't all expire together and only
+a slice of the domains re-list their metrics on any one run.
+'''
+
+import json
+import os
+import random
+import threading
+import time
+
+from client_pool import batch_items
+
+
+class MetricCatalog():
+    ''' In-memory catalog of metric descriptions, optionally backed by a store
+        that keeps it across cold starts. '''
+
+    def __init__(self, record_type, store=None, ttl_s=3600, jitter=0.5):
+        ''' record_type: the namedtuple type for a single metric description.
+                         Cached entries are rebuilt as record_type(*fields)
+            store:       A DynamoDBCatalogStore, FileCatalogStore or None to
+                         cache in memory only (warm invocations)
+            ttl_s:       Maximum age of an entry, in seconds. 0 disables
+                         caching
+            jitter:      Fraction of the TTL that is randomly taken off each
+                         entry's lifetime to spread out expiry '''
+        self._record_type = record_type
+        self._store = store
+        self._ttl_s = ttl_s
+        self._jitter = jitter
+        self._entries = dict()
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _expires(self, now):
+        return now + self._ttl_s * (1 - self._jitter * random.random())
+
+    def _live(self, key, now):
+        entry = self._entries.get(key, None)
+        return entry and entry[0] > now
+
+    def load(self, keys):
+        ''' Pull the stored entries for keys, a list of (region, name) tuples,
+            into memory. Keys that are already cached in memory are skipped.'''
+        if not self._store or not self._ttl_s:
+            return
+        now = time.time()
+        missing = [key for key in keys if not self._live(key, now)]
+        if not missing:
+            return
+        loaded = self._store.load(missing)
+        with self._lock:
+            self._entries.update(loaded)
+
+    def stale(self, keys):
+        ''' Return the keys, (region, name) tuples, that have no live entry
+            and so will be listed by descriptions().'''
+        if not self._ttl_s:
+            return list(keys)
+        now = time.time()
+        return [key for key in keys if not self._live(key, now)]
+
+    def descriptions(self, region, name, list_func):
+        ''' Return the metric descriptions for name in region. Calls
+            list_func(name, region) to list them when there is no live entry in
+            the catalog. Safe to call from several threads.'''
+        key = (region, name)
+        now = time.time()
+        if self._ttl_s and self._live(key, now):
+            with self._lock:
+                self.hits += 1
+            return [self._record_type(*fields) for fields in self._entries[key][1]]
+
+        with self._lock:
+            self.misses += 1
+        metrics = list_func(name, region)
+        # Don't cache an empty list. A new domain may not have published its
+        # metrics yet.
+        if self._ttl_s and metrics:
+            with self._lock:
+                self._entries[key] = (self._expires(now),
+                                      [list(metric) for metric in metrics])
+                self._dirty.add(key)
+        return metrics
+
+    def save(self):
+        ''' Write entries that were refreshed since the last save to the
+            store.'''
+        with self._lock:
+            dirty = {key: self._entries[key] for key in self._dirty}
+            self._dirty = set()
+        if self._store and dirty:
+            self._store.save(dirty)
+        print('Metric catalog: {} cached, {} listed, {} saved'.format(
+            self.hits, self.misses, len(dirty)))
+        self.hits = 0
+        self.misses = 0
+
+
+class DynamoDBCatalogStore():
+    ''' Keeps catalog entries in the timestamp tracking table. Entries are
+        stored under their own keys (domain="metrics#<name>") so they don't
+        collide with the timestamp items.'''
+
+    KEY_PREFIX = 'metrics#'
+    # DynamoDB's item size limit counts attribute names and values. Entries
+    # that would go over it (e.g. collections with many per-index metrics)
+    # would fail their whole batch, so they stay in memory only.
+    MAX_ITEM_BYTES = 400 * 1024
+
+    def __init__(self, client_func, table):
+        ''' client_func: called with no arguments to get a DynamoDB client
+            table:       The table name '''
+        self._client_func = client_func
+        self._table = table
+
+    def _key(self, key):
+        (region, name) = key
+        return {'domain': {'S': self.KEY_PREFIX + name},
+                'region': {'S': region}}
+
+    def load(self, keys):
+        ddb = self._client_func()
+        ret = dict()
+        for start in range(0, len(keys), 100):
+            request = {self._table: {'Keys': [self._key(key)
+                                              for key in keys[start:start + 100]]}}
+            try:
+                for resp in batch_items(ddb.batch_get_item, request,
+                                        'UnprocessedKeys'):
+                    for item in resp.get('Responses', {}).get(self._table, []):
+                        name = item['domain']['S'][len(self.KEY_PREFIX):]
+                        ret[(item['region']['S'], name)] = (
+                            float(item['Expires']['N']),
+                            json.loads(item['Metrics']['S']))
+            except Exception as e:
+                print('Exception loading metric catalog')
+                print(e)
+        return ret
+
+    def save(self, entries):
+        ddb = self._client_func()
+        puts = list()
+        for key, (expires, metrics) in entries.items():
+            item = self._key(key)
+            item['Expires'] = {'N': str(expires)}
+            item['Metrics'] = {'S': json.dumps(metrics)}
+            size = sum(len(name) + len(next(iter(value.values())).encode('utf8'))
+                       for name, value in item.items())
+            if size > self.MAX_ITEM_BYTES:
+                print('Not saving the metric catalog entry for "{}:{}": {} bytes '
+                      'is over the DynamoDB item limit'.format(key[1], key[0], size))
+                continue
+            puts.append({'PutRequest': {'Item': item}})
+        for start in range(0, len(puts), 25):
+            request = {self._table: puts[start:start + 25]}
+            try:
+                for resp in batch_items(ddb.batch_write_item, request,
+                                        'UnprocessedItems'):
+                    pass
+            except Exception as e:
+                print('Exception saving metric catalog')
+                print(e)
+
+
+class FileCatalogStore():
+    ''' Keeps catalog entries in a local JSON file. On Lambda, use a path under
+        /tmp. The file survives for as long as the execution environment
+        does.'''
+
+    def __init__(self, path):
+        self._path = path
+
+    def _read(self):
+        if not os.path.exists(self._path):
+            return dict()
+        try:
+            with open(self._path) as f:
+                return {(region, name): (expires, metrics)
+                        for region, name, expires, metrics in json.load(f)}
+        except Exception as e:
+            print('Exception reading metric catalog "{}"'.format(self._path))
+            print(e)
+        return dict()
+
+    def load(self, keys):
+        stored = self._read()
+        return {key: stored[key] for key in keys if key in stored}
+
+    def save(self, entries):
+        stored = self._read()
+        stored.update(entries)
+        tmp_path = self._path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump([[region, name, expires, metrics]
+                           for (region, name), (expires, metrics) in stored.items()], f)
+            os.replace(tmp_path, self._path)
+        except Exception as e:
+            print('Exception writing metric catalog "{}"'.format(self._path))
+            print(e)
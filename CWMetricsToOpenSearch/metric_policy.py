@@ -0,0 +1,198 @@
+'''
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+
+Decides which CloudWatch metrics are retrieved, with which statistics and at
+what period. Every query costs money and every value becomes a document, so
+metrics that no dashboard uses can be left out, and counters like Nodes or
+ClusterStatus.red can be retrieved with a single statistic.
+
+A policy is a JSON document like:
+
+{
+    "include": ["*"],
+    "exclude": ["ThreadpoolIndex*"],
+    "default": {"stats": ["Minimum", "Maximum", "Average"], "period": 60},
+    "metrics": [
+        {"match": "ClusterStatus.*", "stats": ["Maximum"]},
+        {"match": "Nodes", "stats": ["Maximum"]},
+        {"match": "SearchLatency", "stats": ["Average", "p99"]},
+        {"match": "*", "namespace": "AWS/AOSS", "stats": ["Maximum"]}
+    ],
+    "rollups": [
+        {"metric": "SearchRate", "function": "SUM"},
+        {"metric": "JVMMemoryPressure", "function": "MAX", "raw": false}
+    ]
+}
+
+All keys are optional. Patterns are fnmatch patterns on the metric name.
+A metric is retrieved if it matches an include pattern and no exclude
+pattern. The first entry in "metrics" that matches (and, if it has one, has
+the same namespace) sets the stats and period. Whatever it doesn't set comes
+from "default". Stats are CloudWatch statistics: SampleCount, Average, Sum,
+Minimum, Maximum, or extended statistics like p99 or tm90.
+
+A "period" may be given anywhere, but for now it must equal the default
+period, the Lambda's interval. The retrieval window, its settled watermark
+and the seen set all move one interval at a time. Buckets of a longer
+period would be read while still filling, or shift from run to run.
+
+Rollups are region-wide series that CloudWatch aggregates with Metric Math,
+e.g. SUM(SEARCH('{AWS/ES,ClientId,DomainName} MetricName="SearchRate"',
+'Sum', 60)), so a single series per region crosses the wire instead of one
+per domain. A rollup has:
+
+metric      The metric to aggregate
+function    SUM, AVG, MIN or MAX across the domains or collections
+namespace   AWS/ES (the default) or AWS/AOSS
+stat        The statistic of each domain's series. Defaults to the one that
+            matches function, e.g. Sum for SUM
+period      The default period, the only one allowed for now
+name        The metric name of the rollup's values. Defaults to
+            <metric>_<function>, e.g. SearchRate_sum. Rollup values go to the
+            same index as the metrics, and OpenSearch reads dots in field
+            names as object paths, so a rollup is skipped when its name and
+            a retrieved metric's name are a dotted prefix of one another
+            (e.g. SearchRate.sum and SearchRate, or ClusterStatus and
+            ClusterStatus.red). See field_collision
+search      The SEARCH schema. Defaults to the namespace's domain or
+            collection level schema
+raw         false to stop retrieving the metric per domain or collection,
+            so the rollup replaces it. Defaults to true
+'''
+
+from collections import namedtuple
+from fnmatch import fnmatchcase
+import json
+import re
+import threading
+
+
+MetricSettings = namedtuple('MetricSettings', ['stats', 'period'])
+
+Rollup = namedtuple('Rollup', ['name', 'namespace', 'metric', 'stat', 'function',
+                               'period', 'search', 'raw'])
+
+DEFAULT_STATS = ('Minimum', 'Maximum', 'Average')
+BASIC_STATS = frozenset(['SampleCount', 'Average', 'Sum', 'Minimum', 'Maximum'])
+EXTENDED_STAT = re.compile(r'^(p|tm|tc|ts|wm)\d{1,2}(\.\d+)?$'
+                           r'|^(PR|TM|TC|TS|WM)\(.+\)$')
+
+# Metric Math functions that reduce many series to one, with the statistic
+# that each series should use by default.
+ROLLUP_FUNCTIONS = {'SUM': 'Sum', 'AVG': 'Average', 'MIN': 'Minimum',
+                    'MAX': 'Maximum'}
+SEARCH_SCHEMAS = {'AWS/ES': '{AWS/ES,ClientId,DomainName}',
+                  'AWS/AOSS': '{AWS/AOSS,ClientId,CollectionId,CollectionName}'}
+
+
+def _check_settings(stats, period, interval):
+    for stat in stats:
+        if stat not in BASIC_STATS and not EXTENDED_STAT.match(stat):
+            raise ValueError('Unknown CloudWatch statistic "{}"'.format(stat))
+    if period != interval:
+        raise ValueError('Period must be {}, the retrieval interval, not '
+                         '{}'.format(interval, period))
+
+
+class MetricPolicy():
+    ''' The stats and period to retrieve for each metric. Safe to share
+        between threads. '''
+
+    def __init__(self, policy=None, default_period=60):
+        ''' policy:         A dict, as described above. None retrieves every
+                            metric with the default stats
+            default_period: The retrieval interval, and the only period the
+                            policy may set '''
+        policy = policy or dict()
+        self._interval = default_period
+        default = policy.get('default', dict())
+        self._default = MetricSettings(tuple(default.get('stats', DEFAULT_STATS)),
+                                       int(default.get('period', default_period)))
+        _check_settings(*self._default, self._interval)
+        self._include = list(policy.get('include', ['*']))
+        self._exclude = list(policy.get('exclude', []))
+        self._rules = list()
+        for rule in policy.get('metrics', []):
+            settings = MetricSettings(tuple(rule.get('stats', self._default.stats)),
+                                      int(rule.get('period', self._default.period)))
+            _check_settings(*settings, self._interval)
+            self._rules.append((rule['match'], rule.get('namespace', None), settings))
+        self._rollups = [self._rollup(rollup) for rollup in policy.get('rollups', [])]
+        self._cache = dict()
+        self._lock = threading.Lock()
+
+    def _rollup(self, rollup):
+        function = rollup['function'].upper()
+        if function not in ROLLUP_FUNCTIONS:
+            raise ValueError('Unknown rollup function "{}"'.format(function))
+        namespace = rollup.get('namespace', 'AWS/ES')
+        search = rollup.get('search', SEARCH_SCHEMAS.get(namespace, None))
+        if not search:
+            raise ValueError('No SEARCH schema for namespace "{}"'.format(namespace))
+        ret = Rollup(name=rollup.get('name', '{}_{}'.format(rollup['metric'],
+                                                           function.lower())),
+                     namespace=namespace,
+                     metric=rollup['metric'],
+                     stat=rollup.get('stat', ROLLUP_FUNCTIONS[function]),
+                     function=function,
+                     period=int(rollup.get('period', self._default.period)),
+                     search=search,
+                     raw=bool(rollup.get('raw', True)))
+        _check_settings([ret.stat], ret.period, self._interval)
+        return ret
+
+    @classmethod
+    def from_json(cls, text, default_period=60):
+        ''' Build a policy from a JSON document. Empty text means no policy.'''
+        return cls(json.loads(text) if text and text.strip() else None,
+                   default_period=default_period)
+
+    def _settings(self, namespace, metric_name):
+        if any(rollup.namespace == namespace and rollup.metric == metric_name
+               and not rollup.raw for rollup in self._rollups):
+            return None
+        if not any(fnmatchcase(metric_name, pattern) for pattern in self._include):
+            return None
+        if any(fnmatchcase(metric_name, pattern) for pattern in self._exclude):
+            return None
+        for pattern, rule_namespace, settings in self._rules:
+            if rule_namespace and rule_namespace != namespace:
+                continue
+            if fnmatchcase(metric_name, pattern):
+                return settings
+        return self._default
+
+    def settings(self, namespace, metric_name):
+        ''' Return the MetricSettings for metric_name in namespace (AWS/ES or
+            AWS/AOSS), or None if the metric is not retrieved.'''
+        key = (namespace, metric_name)
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        settings = self._settings(namespace, metric_name)
+        with self._lock:
+            self._cache[key] = settings
+        return settings
+
+    def rollups(self, namespace):
+        ''' The Rollups for namespace.'''
+        return [rollup for rollup in self._rollups if rollup.namespace == namespace]
+
+
+def rollup_expression(rollup):
+    ''' The Metric Math expression for rollup.'''
+    return "{}(SEARCH('{} MetricName=\"{}\"', '{}', {}))".format(
+        rollup.function, rollup.search, rollup.metric, rollup.stat, rollup.period)
+
+
+def field_collision(name, field_names):
+    ''' Return the first of field_names that can't share an index with a field
+        called name, because one is a dotted prefix of the other and
+        OpenSearch would need it to be both a value and an object. None if
+        there is no such field.'''
+    for field in field_names:
+        if field.startswith(name + '.') or name.startswith(field + '.'):
+            return field
+    return None
@@ -0,0 +1,20 @@
+'''
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+
+handler reads its settings from the environment when it's imported. These
+are enough to import it without touching AWS or OpenSearch.
+'''
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('TABLE', 'timestamps')
+os.environ.setdefault('DOMAIN_ENDPOINT', 'https://localhost:9200')
+os.environ.setdefault('DOMAIN_ADMIN_UNAME', 'admin')
+os.environ.setdefault('DOMAIN_ADMIN_PW', 'admin')
+os.environ.setdefault('REGIONS', '["us-east-1"]')
+os.environ.setdefault('SERVERLESS_REGIONS', '["us-east-1"]')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
@@ -0,0 +1,168 @@
+'''
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+'''
+
+import calendar
+from datetime import datetime
+import json
+
+from checkpoint_store import CheckpointStore
+
+
+class ConditionalCheckFailed(Exception):
+    response = {'Error': {'Code': 'ConditionalCheckFailedException'}}
+
+
+class FakeDynamoDB():
+    ''' Just enough of the timestamp table for CheckpointStore.'''
+
+    def __init__(self):
+        self.items = dict()
+        self.updates = 0
+
+    def batch_get_item(self, RequestItems):
+        (table, request), = RequestItems.items()
+        found = [self.items[(key['domain']['S'], key['region']['S'])]
+                 for key in request['Keys']
+                 if (key['domain']['S'], key['region']['S']) in self.items]
+        return {'Responses': {table: found}}
+
+    def update_item(self, TableName, Key, UpdateExpression, ConditionExpression,
+                    ExpressionAttributeNames, ExpressionAttributeValues):
+        self.updates += 1
+        key = (Key['domain']['S'], Key['region']['S'])
+        item = self.items.setdefault(key, dict(Key))
+        stored = item.get('Timestamp', None)
+        if stored and stored['S'] >= ExpressionAttributeValues[':ts']['S']:
+            raise ConditionalCheckFailed()
+        item['Timestamp'] = ExpressionAttributeValues[':ts']
+        if ':seen' in ExpressionAttributeValues:
+            item['Seen'] = ExpressionAttributeValues[':seen']
+
+
+def epoch(minute):
+    return calendar.timegm(datetime(2026, 1, 1, 12, minute).utctimetuple())
+
+
+T0 = datetime(2026, 1, 1, 12, 0)
+T5 = datetime(2026, 1, 1, 12, 5)
+
+
+def new_store(ddb=None, persist_seen=False):
+    ddb = ddb or FakeDynamoDB()
+    return CheckpointStore(lambda: ddb, 'timestamps', persist_seen=persist_seen)
+
+
+def test_unseen_drops_points_read_before():
+    store = new_store()
+    epochs = [epoch(minute) for minute in range(4)]
+    assert store.unseen('dom', 'r', 's', epochs, epoch(0)) == [0, 1, 2, 3]
+    assert store.unseen('dom', 'r', 's', epochs + [epoch(4)], epoch(0)) == [4]
+
+
+def test_unseen_only_remembers_points_after_settled():
+    store = new_store()
+    epochs = [epoch(minute) for minute in range(4)]
+    store.unseen('dom', 'r', 's', epochs, epoch(2))
+    # Points before settled won't be read again, so they aren't kept
+    assert store.unseen('dom', 'r', 's', epochs, epoch(2)) == [0, 1]
+
+
+def test_unseen_keeps_series_and_targets_apart():
+    store = new_store()
+    store.unseen('dom', 'r', 's', [epoch(1)], epoch(0))
+    assert store.unseen('dom', 'r', 'other', [epoch(1)], epoch(0)) == [0]
+    assert store.unseen('other', 'r', 's', [epoch(1)], epoch(0)) == [0]
+
+
+def test_advance_only_moves_forward():
+    store = new_store()
+    store.advance('dom', 'r', T5)
+    store.advance('dom', 'r', T0)
+    assert store.get('dom', 'r') == T5
+
+
+def test_flush_forgets_seen_points_before_the_timestamp():
+    store = new_store()
+    store.unseen('dom', 'r', 's', [epoch(1), epoch(6)], epoch(0))
+    store.advance('dom', 'r', T5)
+    store.flush()
+    assert store.unseen('dom', 'r', 's', [epoch(1), epoch(6)], epoch(5)) == [0]
+
+
+def test_flush_writes_advanced_timestamps_once():
+    ddb = FakeDynamoDB()
+    store = new_store(ddb)
+    store.advance('dom', 'r', T5)
+    store.flush()
+    store.flush()
+    assert ddb.updates == 1
+    assert ddb.items[('dom', 'r')]['Timestamp']['S'] == T5.isoformat()
+
+
+def test_flush_leaves_a_newer_stored_timestamp_alone():
+    ddb = FakeDynamoDB()
+    newer = new_store(ddb)
+    newer.advance('dom', 'r', T5)
+    newer.flush()
+    older = new_store(ddb)
+    older.advance('dom', 'r', T0)
+    older.flush()
+    assert ddb.items[('dom', 'r')]['Timestamp']['S'] == T5.isoformat()
+
+
+def test_flush_uses_fan_out():
+    calls = list()
+
+    def fan_out(batch):
+        calls.extend(batch)
+        return [func(*args) for region, func, args in batch]
+
+    store = new_store()
+    store.advance('a', 'r', T5)
+    store.advance('b', 'r', T5)
+    store.flush(fan_out)
+    assert len(calls) == 2
+
+
+def test_load_keeps_the_newer_timestamp():
+    ddb = FakeDynamoDB()
+    ddb.items[('dom', 'r')] = {'domain': {'S': 'dom'}, 'region': {'S': 'r'},
+                               'Timestamp': {'S': T0.isoformat()}}
+    store = new_store(ddb)
+    store.advance('dom', 'r', T5)
+    store.load([('dom', 'r')])
+    assert store.get('dom', 'r') == T5
+
+
+def test_seen_set_persists_with_the_timestamp():
+    ddb = FakeDynamoDB()
+    store = new_store(ddb, persist_seen=True)
+    store.unseen('dom', 'r', 's', [epoch(6)], epoch(5))
+    store.advance('dom', 'r', T5)
+    store.flush()
+    assert json.loads(ddb.items[('dom', 'r')]['Seen']['S']) == {'s': [epoch(6)]}
+
+    cold = new_store(ddb, persist_seen=True)
+    cold.load([('dom', 'r')])
+    assert cold.unseen('dom', 'r', 's', [epoch(6), epoch(7)], epoch(5)) == [1]
+
+
+def test_discard_restores_timestamps_and_seen_points():
+    ddb = FakeDynamoDB()
+    store = new_store(ddb)
+    store.advance('dom', 'r', T0)
+    store.unseen('dom', 'r', 's', [epoch(1)], epoch(0))
+    store.flush()
+
+    store.advance('dom', 'r', T5)
+    store.advance('new', 'r', T5)
+    store.unseen('dom', 'r', 's', [epoch(1), epoch(6)], epoch(5))
+    store.discard()
+    assert store.get('dom', 'r') == T0
+    assert store.get('new', 'r') is None
+    # Points seen before the last flush stay seen
+    assert store.unseen('dom', 'r', 's', [epoch(1), epoch(6)], epoch(0)) == [1]
+    store.flush()
+    assert ddb.updates == 1
@@ -0,0 +1,40 @@
+'''
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+'''
+
+import pytest
+
+from metric_policy import MetricPolicy, field_collision
+
+
+def test_rollup_names_default_to_metric_and_function():
+    policy = MetricPolicy({'rollups': [{'metric': 'SearchRate', 'function': 'sum'}]})
+    assert [rollup.name for rollup in policy.rollups('AWS/ES')] == ['SearchRate_sum']
+
+
+def test_dotted_rollup_names_are_allowed_at_load():
+    policy = MetricPolicy({'rollups': [{'metric': 'SearchRate', 'function': 'SUM',
+                                        'name': 'fleet.search'}]})
+    assert policy.rollups('AWS/ES')[0].name == 'fleet.search'
+
+
+@pytest.mark.parametrize('name, fields, collision', [
+    ('SearchRate.sum', ['CPUUtilization', 'SearchRate'], 'SearchRate'),
+    ('ClusterStatus', ['ClusterStatus.red', 'ClusterStatus.green'], 'ClusterStatus.red'),
+    ('fleet.search', ['SearchRate'], None),
+    ('SearchRate_sum', ['SearchRate'], None),
+    ('Search', ['SearchRate'], None),
+])
+def test_field_collision(name, fields, collision):
+    assert field_collision(name, fields) == collision
+
+
+@pytest.mark.parametrize('policy', [
+    {'default': {'period': 300}},
+    {'metrics': [{'match': '*', 'period': 300}]},
+    {'rollups': [{'metric': 'SearchRate', 'function': 'SUM', 'period': 5}]},
+])
+def test_periods_other_than_the_interval_are_rejected(policy):
+    with pytest.raises(ValueError):
+        MetricPolicy(policy, default_period=60)
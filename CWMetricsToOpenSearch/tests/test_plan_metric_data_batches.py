@@ -0,0 +1,101 @@
+'''
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+'''
+
+from datetime import datetime, timedelta
+
+import pytest
+
+import handler
+from handler import MAX_QUERIES_PER_REQUEST, MetricDataTarget, \
+    TargetProgress, plan_metric_data_batches, settled_time
+
+
+NOW = datetime(2026, 1, 1, 12, 30, 45)
+LAST = datetime(2026, 1, 1, 12, 20)
+
+
+def target(name, queries, region='us-east-1'):
+    return MetricDataTarget(region, name,
+                            [{'Id': '{}{}'.format(name, pos)} for pos in range(queries)],
+                            dict())
+
+
+def test_settled_time_is_settle_s_back_on_the_minute():
+    settled = settled_time(NOW)
+    assert settled.second == 0 and settled.microsecond == 0
+    assert NOW - timedelta(seconds=handler.SETTLE_S + 60) < settled
+    assert settled <= NOW - timedelta(seconds=handler.SETTLE_S)
+
+
+def test_targets_with_the_same_window_share_a_call():
+    batches = plan_metric_data_batches([target('a', 10), target('b', 20)],
+                                       [LAST, LAST], NOW)
+    assert len(batches) == 1
+    assert batches[0].targets == ['a', 'b']
+    assert len(batches[0].queries) == 30
+    assert batches[0].start_time == LAST
+    assert batches[0].end_time == NOW
+    assert batches[0].settled_time == settled_time(NOW)
+
+
+def test_calls_cover_one_region_and_window():
+    batches = plan_metric_data_batches(
+        [target('a', 10), target('b', 10, region='us-west-2'), target('c', 10)],
+        [LAST, LAST, LAST - timedelta(minutes=1)], NOW)
+    assert sorted((batch.region, batch.start_time, tuple(batch.targets))
+                  for batch in batches) == [
+        ('us-east-1', LAST - timedelta(minutes=1), ('c',)),
+        ('us-east-1', LAST, ('a',)),
+        ('us-west-2', LAST, ('b',))]
+
+
+def test_new_targets_start_initial_lookback_s_back():
+    batches = plan_metric_data_batches([target('a', 1)], [None], NOW)
+    assert batches[0].start_time == NOW - timedelta(seconds=handler.INITIAL_LOOKBACK_S)
+
+
+def test_a_target_that_does_not_fit_starts_a_new_call():
+    batches = plan_metric_data_batches([target('a', 300), target('b', 300)],
+                                       [LAST, LAST], NOW)
+    assert [batch.targets for batch in batches] == [['a'], ['b']]
+
+
+def test_large_targets_are_split_across_calls():
+    batches = plan_metric_data_batches(
+        [target('a', MAX_QUERIES_PER_REQUEST + 100), target('b', 1)],
+        [LAST, LAST], NOW)
+    assert [len(batch.queries) for batch in batches] == [MAX_QUERIES_PER_REQUEST, 101]
+    assert [batch.targets for batch in batches] == [['a'], ['a', 'b']]
+    ids = [query['Id'] for batch in batches for query in batch.queries]
+    assert len(ids) == len(set(ids)) == MAX_QUERIES_PER_REQUEST + 101
+
+
+@pytest.fixture
+def advanced(monkeypatch):
+    calls = list()
+    monkeypatch.setattr(handler.CHECKPOINTS, 'advance',
+                        lambda name, region, ts: calls.append(name))
+    return calls
+
+
+def test_split_targets_advance_once_every_call_succeeds(advanced):
+    batches = plan_metric_data_batches(
+        [target('a', MAX_QUERIES_PER_REQUEST + 100), target('b', 1)],
+        [LAST, LAST], NOW)
+    progress = TargetProgress(batches)
+    progress.succeeded(batches[1])
+    assert advanced == ['b']
+    progress.succeeded(batches[0])
+    assert advanced == ['b', 'a']
+
+
+def test_split_targets_stay_put_when_a_call_fails(advanced):
+    batches = plan_metric_data_batches(
+        [target('a', MAX_QUERIES_PER_REQUEST + 100), target('b', 1)],
+        [LAST, LAST], NOW)
+    progress = TargetProgress(batches)
+    progress.failed(batches[1])
+    progress.succeeded(batches[0])
+    assert advanced == []